@@ -1,10 +1,11 @@
 #!/usr/bin/python3
-import stitch
 import sys
 import os
-import seams
-import gui
 import util
+import timing
+
+# Each command only imports the modules it needs, so that commands which don't
+# show any windows start quickly and work without Tk installed
 
 HELP_STRING = """
 This is a Texture stitching program.
@@ -17,15 +18,102 @@ Open the Stitch Editor GUI
 stitch new {filename}
 Create a new stitch file by manually picking files.
 
-stitch newseam {filename}
-Create a new stitch file by automatically matching
-seams.
+stitch newseam {filename} [options]
+Create new stitch files by automatically matching
+seams. Textures are grouped by size, and a stitch
+file is created for every grid of textures found.
+If there are several, they are numbered, e.g.
+{name}_1.json. Textures are picked with a dialog
+unless --dir or --stdin is given. Options:
+  --dir {folder}      use textures in a folder
+  --pattern {glob}    only use textures in --dir whose
+                      names match, e.g. '*.png'
+  --stdin             read texture names from stdin,
+                      one per line
+  --summary {file}    write a json list of used and
+                      unused textures
+  --jobs N            decode N textures, and solve N
+                      texture sizes, at the same time,
+                      0 meaning one per CPU
+  --no-cache          don't use '.texstitch-cache'
+                      files, which remember the edges
+                      of each texture between runs
 
-stitch pack {filename} {imagename}
+stitch pack {filename} {imagename} [options]
 Pack a stitch project's textures into a single image.
+Options:
+  --jobs N        decode N textures at the same time,
+                  0 meaning one per CPU
+  --stream        write a PNG one row of textures at a
+                  time, for images too large to fit in
+                  memory
+  --incremental   only update the tiles whose textures
+                  changed since the image was last
+                  packed with --incremental. A
+                  '{imagename}.manifest.json' file is
+                  kept next to the image.
 
-stitch unpack {filename} {imagename}
+stitch unpack {filename} {imagename} [--jobs N]
 Split an image into multiple textures as defined by a stitch project.
+Only textures that changed are written. --jobs sets how many textures
+are encoded at the same time, 0 meaning one per CPU.
+
+stitch pack-many {listfile} [options]
+stitch unpack-many {listfile} [options]
+Pack or unpack many stitch projects at once. Each line
+of {listfile} holds a project and its image. Options:
+  --glob {pattern}  use every project matching a pattern
+                    instead of {listfile}, each with an
+                    image of the same name
+  --ext {ext}       extension of images used with
+                    --glob, .png by default
+  --jobs N          run N projects at the same time,
+                    0 meaning one per CPU
+  --cache-size MB   memory used to keep textures shared
+                    between projects decoded (pack-many)
+  --incremental     same as pack --incremental
+                    (pack-many)
+
+stitch verify {filename} [imagename]
+List textures that changed since they were last
+unpacked or verified, or with an image, textures
+that differ from that image.
+
+stitch watch {filename} {imagename} [options]
+Keep a stitch project's textures and image in sync.
+When the image changes, the textures whose cells
+changed are unpacked. When textures change, their
+cells are packed into the image. Options:
+  --interval S    check for changes every S seconds,
+                  0.5 by default
+  --debounce S    wait until files have not changed
+                  for S seconds before syncing them,
+                  1 by default
+  --jobs N        encode N textures at the same time,
+                  0 meaning one per CPU
+
+stitch serve [options]
+Answer pack, unpack, verify and newseam requests over
+HTTP, keeping projects and decoded textures in memory
+between requests. Options:
+  --host {host}       address to listen on, 127.0.0.1 by
+                      default
+  --port N            port to listen on, 8765 by default
+  --jobs N            decode N textures at the same time,
+                      0 meaning one per CPU
+  --cache-size MB     memory used to keep textures decoded
+  --max-projects N    number of projects to keep loaded,
+                      32 by default
+
+Every command also takes these options:
+  --profile         print the time, number of calls and
+                    peak memory of each phase, such as
+                    decoding and saving textures. Tracing
+                    memory slows the command down.
+  --trace {file}    write every call of each phase as a
+                    Chrome trace, for chrome://tracing
+  --cprofile {file} write cProfile stats of the command,
+                    for pstats or snakeviz
 
 Auto stitch creation requires the given textures to have matching edges.
 Any textures given to auto that aren't in the output image will be moved to a
@@ -40,30 +128,77 @@ def stitch_help():
     print(HELP_STRING)
 
 
+def run_command(base_path, fname, passed_args):
+    if fname == "new":
+        import stitch
+        stitch.stitch_new(base_path, passed_args,
+                          stitch.pick_files_individual)
+    elif fname == "newseam":
+        import seams
+        seams.stitch_newseam(base_path, passed_args)
+    elif fname == "gui":
+        import gui
+        gui.open_gui(base_path)
+    elif fname == "pack":
+        import stitch
+        stitch.stitch_pack(base_path, passed_args)
+    elif fname == "unpack":
+        import stitch
+        stitch.stitch_unpack(base_path, passed_args)
+    elif fname == "pack-many":
+        import batch
+        batch.stitch_pack_many(base_path, passed_args)
+    elif fname == "unpack-many":
+        import batch
+        batch.stitch_unpack_many(base_path, passed_args)
+    elif fname == "verify":
+        import stitch
+        stitch.stitch_verify(base_path, passed_args)
+    elif fname == "watch":
+        import watch
+        watch.stitch_watch(base_path, passed_args)
+    elif fname == "serve":
+        import server
+        server.stitch_serve(base_path, passed_args)
+    elif fname == "help" or fname is None:
+        stitch_help()
+    else:
+        print("Not a valid command.")
+
+
 def main(args):
     util.data_path = os.path.dirname(args[0])
     base_path = os.getcwd()
     if len(args) < 2:
         # stitch_help()
+        import gui
         gui.open_gui(base_path)
-    else:
-        fname = args[1]
-        passed_args = args[2:]
-        if fname == "new":
-            stitch.stitch_new(base_path, passed_args,
-                              stitch.pick_files_individual)
-        elif fname == "newseam":
-            stitch.stitch_new(base_path, passed_args, seams.pick_files_auto)
-        elif fname == "gui":
-            gui.open_gui(base_path)
-        elif fname == "pack":
-            stitch.stitch_pack(base_path, passed_args)
-        elif fname == "unpack":
-            stitch.stitch_unpack(base_path, passed_args)
-        elif fname == "help" or fname is None:
-            stitch_help()
-        else:
-            print("Not a valid command.")
+        return
+    fname = args[1]
+    passed_args = args[2:]
+    profile = util.pop_flag(passed_args, "--profile")
+    trace = util.pop_option(passed_args, "--trace")
+    cprofile = util.pop_option(passed_args, "--cprofile")
+    if profile or trace is not None:
+        timing.start(trace is not None)
+    profiler = None
+    if cprofile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # Commands may exit early, which should still be reported
+    try:
+        run_command(base_path, fname, passed_args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+        if timing.enabled:
+            timing.stop()
+            if profile:
+                timing.print_report()
+            if trace is not None:
+                timing.write_trace(trace)
 
 
 if __name__ == "__main__":
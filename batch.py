@@ -0,0 +1,207 @@
+import os
+import sys
+import glob
+import time
+import shlex
+from concurrent import futures
+
+from PIL import Image
+import util
+import stitch
+import tilecache
+import incremental
+
+
+def read_project_list(fname):
+    '''
+    Read a list of projects to pack or unpack. Each line holds a stitch
+    project and its image, separated by whitespace. Paths are relative to the
+    list, may be quoted, and '#' starts a comment.
+
+    Returns a list of (project filename, image filename)
+    '''
+    path = os.path.dirname(os.path.abspath(fname))
+    projects = []
+    with open(fname, 'r') as fh:
+        for lineno, line in enumerate(fh, 1):
+            parts = shlex.split(line, comments=True)
+            if len(parts) == 0:
+                continue
+            if len(parts) != 2:
+                print("{}:{}: expected a project and an image"
+                      .format(fname, lineno))
+                sys.exit()
+            projects.append((os.path.join(path, parts[0]),
+                             os.path.join(path, parts[1])))
+    return projects
+
+
+def glob_projects(path, pattern, ext):
+    '''
+    Find stitch projects matching a glob pattern. Each project's image has
+    the same name as the project with the given extension, e.g. 'room.json'
+    and 'room.png'.
+
+    Returns a list of (project filename, image filename)
+    '''
+    projects = []
+    for name in sorted(glob.glob(os.path.join(path, pattern))):
+        # Don't mistake the manifests of incremental packs for projects
+        if name.endswith(incremental.MANIFEST_SUFFIX):
+            continue
+        projects.append((name, os.path.splitext(name)[0] + ext))
+    return projects
+
+
+def chain_projects(projects):
+    '''
+    Group projects that share textures, so that projects writing to the same
+    textures can be run one after another rather than at the same time
+
+    Returns a list of lists of (project filename, image filename)
+    '''
+    # Each project starts in its own chain, and chains are merged whenever
+    # they share a texture
+    chains = {}
+    owner = {}
+    for i, project in enumerate(projects):
+        chain = i
+        chains[chain] = [project]
+        try:
+            texlist = stitch.StitchData.import_from_json(project[0]).texlist
+        except (IOError, ValueError, KeyError):
+            # Let the error be reported when the project is run
+            continue
+        for fname in texlist:
+            other = owner.get(fname, chain)
+            if other != chain:
+                chains[other].extend(chains.pop(chain))
+                for name, value in owner.items():
+                    if value == chain:
+                        owner[name] = other
+                chain = other
+            owner[fname] = chain
+    return list(chains.values())
+
+
+def pack_project(datafile, imagename, use_incremental=False):
+    '''
+    Pack a single project, returning a message describing what was done
+    '''
+    data = stitch.StitchData.import_from_json(datafile)
+    if use_incremental:
+        changed, total = incremental.pack_incremental(data, imagename)
+        return "updated {} of {} tiles".format(changed, total)
+    data.get_stitched_image().save(imagename)
+    return "packed {} textures".format(len(data.texlist))
+
+
+def unpack_project(datafile, imagename):
+    '''
+    Unpack a single project, returning a message describing what was done.
+    Raises the first error if any texture could not be unpacked.
+    '''
+    data = stitch.StitchData.import_from_json(datafile)
+    image = Image.open(imagename).convert("RGBA")
+    indexed = dict(data.tile_index)
+    written, errors = data.unpack_image(image)
+    if data.version >= 2 and data.tile_index != indexed:
+        data.export_to_json(update_index=False)
+    if len(errors) > 0:
+        fname, error = errors[0]
+        raise IOError("{} textures could not be unpacked, such as {}: {}"
+                      .format(len(errors), fname, error))
+    return "wrote {} of {} textures".format(written, len(data.texlist))
+
+
+def run_projects(chains, func, jobs, *args):
+    '''
+    Run func(project, image, *args) for every project on a shared pool of
+    threads, printing how long each project took. Projects in the same chain
+    are run one after another.
+
+    chains - list of lists of (project filename, image filename)
+
+    Returns the number of projects that failed
+    '''
+    failed = 0
+    start = time.perf_counter()
+
+    def run_chain(chain):
+        results = []
+        for datafile, imagename in chain:
+            t = time.perf_counter()
+            try:
+                message = func(datafile, imagename, *args)
+            except (IOError, ValueError, KeyError) as e:
+                message = "failed: {}".format(e)
+                t = None
+            if t is not None:
+                message += " in {:.2f}s".format(time.perf_counter() - t)
+            results.append((datafile, message, t is not None))
+        return results
+
+    count = 0
+    with util.make_pool(jobs) as pool:
+        pending = [pool.submit(run_chain, chain) for chain in chains]
+        for future in futures.as_completed(pending):
+            for datafile, message, ok in future.result():
+                print("{}: {}".format(datafile, message))
+                count += 1
+                if not ok:
+                    failed += 1
+    print("Finished {} projects in {:.2f}s.".format(
+        count, time.perf_counter() - start))
+    return failed
+
+
+def get_projects(path, args):
+    '''
+    Parse the arguments shared by pack-many and unpack-many, returning the
+    list of projects to run
+    '''
+    pattern = util.pop_option(args, "--glob")
+    ext = util.pop_option(args, "--ext", ".png")
+    if not ext.startswith("."):
+        ext = "." + ext
+    if pattern is not None:
+        if len(args) != 0:
+            print("Invalid arguments")
+            sys.exit()
+        return glob_projects(path, pattern, ext)
+    if len(args) != 1:
+        print("Invalid arguments")
+        sys.exit()
+    return read_project_list(os.path.join(path, args[0]))
+
+
+def stitch_pack_many(path, args):
+    '''
+    Pack many stitch projects at once. Tiles shared between projects are only
+    decoded once, as long as they fit in the tile cache. This holds with
+    --incremental too, where only changed tiles are decoded in the first
+    place.
+    '''
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    cache_size = util.pop_option(args, "--cache-size", None, int)
+    use_incremental = util.pop_flag(args, "--incremental")
+    projects = get_projects(path, args)
+    if cache_size is not None:
+        tilecache.shared.set_max_bytes(cache_size * 1024 * 1024)
+    chains = [[project] for project in projects]
+    if run_projects(chains, pack_project, jobs, use_incremental) > 0:
+        sys.exit(1)
+
+
+def stitch_unpack_many(path, args):
+    '''
+    Unpack many stitch projects at once. Projects that share textures are
+    unpacked one after another.
+    '''
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    projects = get_projects(path, args)
+    # Projects sharing textures would overwrite each other's textures at the
+    # same time, so those are unpacked one after another
+    chains = chain_projects(projects)
+    if run_projects(chains, unpack_project, jobs) > 0:
+        sys.exit(1)
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+'''
+Micro-benchmark comparing seams.img_cmp against the per-pixel comparison it
+replaced, on the edges that auto stitching compares.
+
+Usage: python3 benchmarks/bench_img_cmp.py [repeat]
+'''
+import os
+import sys
+import random
+import timeit
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import seams # NOQA
+
+# (texture size, edge position, edge size)
+EDGES = [
+    ("64x32 vertical", (64, 32), (63, 0), (1, 32)),
+    ("64x32 horizontal", (64, 32), (0, 31), (64, 1)),
+    ("320x8 vertical", (320, 8), (319, 0), (1, 8)),
+    ("320x8 horizontal", (320, 8), (0, 7), (320, 1)),
+    ("320x8 block", (320, 8), (0, 0), (320, 8)),
+]
+
+
+def random_image(size, rnd):
+    data = bytes(rnd.getrandbits(8) for _ in range(size[0]*size[1]*4))
+    return Image.frombytes("RGBA", size, data)
+
+
+def bench_edge(size, pos, edge_size, repeat, rnd):
+    '''
+    Time both comparison functions on two images with a matching edge
+
+    Returns the number of seconds per call of (img_cmp_pixels, img_cmp)
+    '''
+    img1 = random_image(size, rnd)
+    img2 = random_image(size, rnd)
+    # Make the compared edge match so that neither function exits early
+    img2.paste(img1.crop((pos[0], pos[1], pos[0]+edge_size[0],
+                          pos[1]+edge_size[1])), (0, 0))
+    assert seams.img_cmp(img1, img2, pos, (0, 0), edge_size)
+    assert seams.img_cmp_pixels(img1, img2, pos, (0, 0), edge_size)
+    results = []
+    for func in (seams.img_cmp_pixels, seams.img_cmp):
+        t = timeit.timeit(
+            lambda: func(img1, img2, pos, (0, 0), edge_size), number=repeat)
+        results.append(t / repeat)
+    return results
+
+
+def main(args):
+    repeat = 2000
+    if len(args) > 1:
+        repeat = int(args[1])
+    rnd = random.Random(0)
+    print("{:<18} {:>12} {:>12} {:>8}".format(
+        "edge", "pixels (us)", "img_cmp (us)", "speedup"))
+    for name, size, pos, edge_size in EDGES:
+        slow, fast = bench_edge(size, pos, edge_size, repeat, rnd)
+        print("{:<18} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            name, slow * 1e6, fast * 1e6, slow / fast))
+
+
+if __name__ == "__main__":
+    main(sys.argv[:])
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+'''
+Benchmark of how long 'stitch pack' takes to run on a tiny project, which is
+mostly the time spent starting up and importing modules. It is run as is, and
+again with the GUI's modules imported first, as every command used to.
+
+Usage: python3 benchmarks/bench_startup.py [repeat]
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import stitch # NOQA
+
+# Runs the program from a directory like 'python3 {ROOT}' does, after
+# importing the given modules, then prints whether tkinter was imported
+RUNNER = '''
+import sys, runpy
+sys.path.insert(0, {root!r})
+for name in {preload!r}:
+    __import__(name)
+sys.argv = [{root!r}] + {args!r}
+try:
+    runpy.run_path({root!r}, run_name="__main__")
+finally:
+    print("tkinter" in sys.modules, file=sys.stderr)
+'''
+
+VARIANTS = [
+    ("lazy imports", []),
+    ("gui imported", ["gui", "seams", "tkinter.filedialog", "PIL.ImageTk"]),
+]
+
+
+def make_project(path):
+    '''
+    Create a project with a few small textures, returning its filename
+    '''
+    data = stitch.StitchData()
+    data.width = 2
+    data.tex_width = 8
+    data.tex_height = 8
+    for i in range(4):
+        fname = os.path.join(path, "tex{}.png".format(i))
+        Image.new("RGBA", (8, 8), (i * 60, 0, 0, 255)).save(fname)
+        data.texlist.append(fname)
+    data.path = os.path.join(path, "project.json")
+    data.export_to_json()
+    return data.path
+
+
+def run(preload, args, cwd):
+    '''
+    Run the program once
+
+    Returns (seconds taken, whether tkinter was imported)
+    '''
+    code = RUNNER.format(root=ROOT, preload=preload, args=args)
+    t = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    seconds = time.perf_counter() - t
+    return seconds, result.stderr.strip().splitlines()[-1] == "True"
+
+
+def main(args):
+    repeat = 10
+    if len(args) > 1:
+        repeat = int(args[1])
+    path = tempfile.mkdtemp(prefix="texstitch-startup-")
+    try:
+        project = make_project(path)
+        cmd = ["pack", project, os.path.join(path, "out.png")]
+        print("{:<14} {:>10} {:>10} {:>9}".format(
+            "variant", "min (ms)", "mean (ms)", "tkinter"))
+        for name, preload in VARIANTS:
+            times = []
+            for _ in range(repeat):
+                seconds, has_tk = run(preload, cmd, path)
+                times.append(seconds)
+            print("{:<14} {:>10.1f} {:>10.1f} {:>9}".format(
+                name, min(times) * 1000, sum(times) / len(times) * 1000,
+                "loaded" if has_tk else "-"))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[:])
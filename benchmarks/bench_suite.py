@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+'''
+Benchmark suite timing auto stitching, packing and unpacking on synthetic
+sets of textures with known seams.
+
+Usage: python3 benchmarks/bench_suite.py [options]
+
+Options:
+    --kinds k1,k2      kinds of sets to run, any of grid-64x32, strips-324x8
+                       and random-sizes (default: all)
+    --counts n1,n2     numbers of textures per set (default: 10,1000,10000)
+    --repeat n         times to run each step, the fastest run is kept
+                       (default: 3)
+    --data dir         where to generate sets, kept between runs so they only
+                       have to be generated once (default: a temporary
+                       directory that is removed afterwards)
+    --output file      write results as JSON to file ('-' for stdout)
+    --baseline file    compare results against the JSON of an earlier run
+    --threshold x      ratio to baseline above which a step counts as a
+                       regression (default: 1.25). Exits with status 1 if any
+                       step regressed.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import util # NOQA
+import seams # NOQA
+import stitch # NOQA
+import tilecache # NOQA
+import synthetic # NOQA
+
+RESULTS_VERSION = 1
+COUNTS = [10, 1000, 10000]
+STEPS = ["load_image_nodes", "compare_image_nodes", "put_nodes_into_data",
+         "get_stitched_image", "get_stitched_image_cached", "unpack_image",
+         "unpack_image_unchanged"]
+
+
+def copy_nodes(imgnodes):
+    '''
+    Get unlinked copies of nodes, so that linking can be timed again without
+    decoding the textures again
+    '''
+    return {fname: seams.EdgeNode(fname, node.width, node.height, node.edges)
+            for fname, node in imgnodes.items()}
+
+
+def timed(times, step, func, *args):
+    t = time.perf_counter()
+    result = func(*args)
+    times.setdefault(step, []).append(time.perf_counter() - t)
+    return result
+
+
+def check_grid(info, data):
+    '''
+    Check that auto stitching put exactly the grid containing the first
+    texture into data
+    '''
+    first = info["files"][0]
+    for columns, width, height, fnames in info["grids"]:
+        if first in fnames:
+            if data.texlist != fnames or data.width != columns:
+                raise AssertionError("Grid of {} was not found".format(first))
+            return
+    raise AssertionError("{} is in no grid".format(first))
+
+
+def run_set(info, outpath, repeat):
+    '''
+    Time every step on a set of textures
+
+    Returns a dict of step name to list of seconds per run
+    '''
+    times = {}
+    for _ in range(repeat):
+        imgnodes = timed(times, "load_image_nodes", seams.load_image_nodes,
+                         info["files"], 1, False, False)
+    for _ in range(repeat):
+        nodes = copy_nodes(imgnodes)
+        timed(times, "compare_image_nodes", seams.compare_image_nodes, nodes)
+        data = stitch.StitchData()
+        timed(times, "put_nodes_into_data", seams.put_nodes_into_data,
+              nodes, data)
+        check_grid(info, data)
+    for _ in range(repeat):
+        tilecache.shared.clear()
+        image = timed(times, "get_stitched_image", data.get_stitched_image)
+        timed(times, "get_stitched_image_cached", data.get_stitched_image)
+    tilecache.shared.clear()
+    # Unpacking pastes into existing textures, so unpack into copies of the
+    # set. The image is inverted so that every texture has to be written,
+    # then it is unpacked again when nothing needs to be written.
+    image = Image.eval(image, lambda value: 255 - value)
+    outdata = stitch.StitchData()
+    outdata.width = data.width
+    outdata.tex_width = data.tex_width
+    outdata.tex_height = data.tex_height
+    outdata.texlist = [os.path.join(outpath, os.path.basename(fname))
+                       for fname in data.texlist]
+    for _ in range(repeat):
+        shutil.rmtree(outpath, ignore_errors=True)
+        os.makedirs(outpath)
+        for fname, outname in zip(data.texlist, outdata.texlist):
+            shutil.copyfile(fname, outname)
+        outdata.tile_index = {}
+        written, errors = timed(times, "unpack_image", outdata.unpack_image,
+                                image)
+        assert written == len(outdata.texlist) and len(errors) == 0
+        written, errors = timed(times, "unpack_image_unchanged",
+                                outdata.unpack_image, image)
+        assert written == 0 and len(errors) == 0
+    shutil.rmtree(outpath, ignore_errors=True)
+    return times
+
+
+def summarize(times):
+    return {step: {"min": min(t), "mean": sum(t) / len(t), "runs": len(t)}
+            for step, t in times.items()}
+
+
+def compare_results(results, baseline, threshold, fh=sys.stdout):
+    '''
+    Print how each step compares with the baseline to fh
+
+    Returns the number of steps that regressed
+    '''
+    regressed = 0
+    print("{:<28} {:<26} {:>10} {:>10} {:>7}".format(
+        "set", "step", "base (ms)", "now (ms)", "ratio"), file=fh)
+    for name, steps in results["sets"].items():
+        base_steps = baseline["sets"].get(name)
+        if base_steps is None:
+            continue
+        for step in STEPS:
+            if step not in steps or step not in base_steps:
+                continue
+            now = steps[step]["min"]
+            base = base_steps[step]["min"]
+            ratio = now / base if base > 0 else float("inf")
+            mark = ""
+            if ratio > threshold:
+                mark = " REGRESSED"
+                regressed += 1
+            print("{:<28} {:<26} {:>10.2f} {:>10.2f} {:>6.2f}x{}".format(
+                name, step, base * 1000, now * 1000, ratio, mark), file=fh)
+    return regressed
+
+
+def print_results(results):
+    print("{:<28} {:<26} {:>10} {:>10}".format(
+        "set", "step", "min (ms)", "mean (ms)"))
+    for name, steps in results["sets"].items():
+        for step in STEPS:
+            if step in steps:
+                print("{:<28} {:<26} {:>10.2f} {:>10.2f}".format(
+                    name, step, steps[step]["min"] * 1000,
+                    steps[step]["mean"] * 1000))
+
+
+def main(args):
+    kinds = util.pop_option(args, "--kinds", list(synthetic.KINDS),
+                            lambda s: s.split(","))
+    counts = util.pop_option(args, "--counts", COUNTS,
+                             lambda s: [int(n) for n in s.split(",")])
+    repeat = util.pop_option(args, "--repeat", 3, int)
+    datapath = util.pop_option(args, "--data")
+    output = util.pop_option(args, "--output")
+    baseline_name = util.pop_option(args, "--baseline")
+    threshold = util.pop_option(args, "--threshold", 1.25, float)
+    if len(args) != 0 or repeat < 1:
+        print(__doc__)
+        sys.exit()
+    for kind_name in kinds:
+        if kind_name not in synthetic.KINDS:
+            print("Unknown kind '{}'".format(kind_name))
+            sys.exit()
+    baseline = None
+    if baseline_name is not None:
+        with open(baseline_name, 'r') as fh:
+            baseline = json.loads(fh.read())
+    is_temporary = datapath is None
+    if is_temporary:
+        datapath = tempfile.mkdtemp(prefix="texstitch-bench-")
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "sets": {},
+    }
+    try:
+        for kind_name in kinds:
+            for count in counts:
+                name = "{}/{}".format(kind_name, count)
+                # Progress goes to stderr so JSON can be written to stdout
+                print("Generating {}...".format(name), file=sys.stderr)
+                info = synthetic.generate_set(
+                    os.path.join(datapath, kind_name, str(count)),
+                    kind_name, count)
+                print("Running {}...".format(name), file=sys.stderr)
+                times = run_set(info, os.path.join(datapath, "unpacked"),
+                                repeat)
+                results["sets"][name] = summarize(times)
+    finally:
+        if is_temporary:
+            shutil.rmtree(datapath, ignore_errors=True)
+    if output == "-":
+        print(json.dumps(results, indent=4))
+    else:
+        if output is not None:
+            with open(output, 'w') as fh:
+                fh.write(json.dumps(results, indent=4))
+        print_results(results)
+    if baseline is not None:
+        fh = sys.stderr if output == "-" else sys.stdout
+        print(file=fh)
+        regressed = compare_results(results, baseline, threshold, fh)
+        if regressed > 0:
+            print("{} steps regressed".format(regressed), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
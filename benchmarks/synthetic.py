@@ -0,0 +1,145 @@
+'''
+Generators for synthetic sets of textures whose seams are known, for
+benchmarking auto stitching, packing and unpacking.
+
+Each set is cut out of random noise into grids of tiles. Neighbouring tiles
+overlap by one pixel, so that the right column of a tile is the same as the
+left column of the tile to its right, and likewise for rows, just as auto
+stitching expects.
+'''
+import os
+import math
+import json
+import random
+
+from PIL import Image
+
+# Name of the file written once a set has been fully generated
+MARKER_NAME = "set.json"
+
+# Kinds of sets, each generating a list of (columns, tile width, tile height,
+# number of tiles) grids for a given number of tiles
+KINDS = {}
+
+
+def get_columns(count):
+    '''
+    Get the number of columns of the squarest grid that count tiles fill
+    completely
+    '''
+    columns = math.isqrt(count)
+    while count % columns != 0:
+        columns -= 1
+    return columns
+
+
+def kind(func):
+    KINDS[func.__name__.replace("_", "-")] = func
+    return func
+
+
+@kind
+def grid_64x32(count, rnd):
+    '''
+    One square-ish grid of 64x32 textures
+    '''
+    return [(get_columns(count), 64, 32, count)]
+
+
+@kind
+def strips_324x8(count, rnd):
+    '''
+    One column of 324x8 strips
+    '''
+    return [(1, 324, 8, count)]
+
+
+@kind
+def random_sizes(count, rnd):
+    '''
+    Several grids, each with its own randomly chosen texture size
+    '''
+    grids = []
+    while count > 0:
+        n = min(count, rnd.randint(1, max(1, count // 2)))
+        width = rnd.randint(4, 96)
+        height = rnd.randint(4, 96)
+        columns = rnd.choice([c for c in range(1, n+1) if n % c == 0])
+        grids.append((columns, width, height, n))
+        count -= n
+    return grids
+
+
+def noise(width, height, rnd):
+    return Image.frombytes("RGBA", (width, height),
+                           rnd.randbytes(width * height * 4))
+
+
+def generate_grid(path, prefix, columns, width, height, count, rnd):
+    '''
+    Cut a grid of tiles out of random noise and save them
+
+    Returns the filenames of the tiles, from left to right and top to bottom
+    '''
+    rows = math.ceil(count / columns)
+    source = noise((width-1) * columns + 1, (height-1) * rows + 1, rnd)
+    fnames = []
+    for i in range(count):
+        x = (i % columns) * (width-1)
+        y = (i // columns) * (height-1)
+        fname = os.path.join(path, "{}_{:05}.png".format(prefix, i))
+        source.crop((x, y, x+width, y+height)).save(fname, compress_level=1)
+        fnames.append(fname)
+    return fnames
+
+
+def generate_set(path, kind_name, count, seed=0):
+    '''
+    Generate a set of textures into a directory, unless it has already been
+    generated there
+
+    path      - directory to put the set into
+    kind_name - key of KINDS
+    count     - number of textures
+    seed      - seed of the random noise and sizes
+
+    Returns a dict with the set's 'files', shuffled so that nothing depends
+    on textures being given in order, and its 'grids' of
+    [columns, width, height, filenames]
+    '''
+    marker = os.path.join(path, MARKER_NAME)
+    try:
+        with open(marker, 'r') as fh:
+            info = json.loads(fh.read())
+        if info["kind"] == kind_name and info["count"] == count and\
+                info["seed"] == seed:
+            info["files"] = [os.path.join(path, f) for f in info["files"]]
+            for grid in info["grids"]:
+                grid[3] = [os.path.join(path, f) for f in grid[3]]
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    os.makedirs(path, exist_ok=True)
+    rnd = random.Random("{}/{}/{}".format(kind_name, count, seed))
+    grids = []
+    files = []
+    for i, (columns, width, height, n) in enumerate(KINDS[kind_name](
+            count, rnd)):
+        fnames = generate_grid(path, "g{}".format(i), columns, width, height,
+                               n, rnd)
+        grids.append([columns, width, height, fnames])
+        files.extend(fnames)
+    rnd.shuffle(files)
+    info = {
+        "kind": kind_name,
+        "count": count,
+        "seed": seed,
+        "files": [os.path.basename(f) for f in files],
+        "grids": [[c, w, h, [os.path.basename(f) for f in fnames]]
+                  for c, w, h, fnames in grids],
+    }
+    with open(marker, 'w') as fh:
+        fh.write(json.dumps(info))
+    info["files"] = files
+    info["grids"] = grids
+    return info
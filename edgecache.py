@@ -0,0 +1,177 @@
+import os
+import json
+import base64
+import collections
+
+CACHE_NAME = ".texstitch-cache"
+CACHE_VERSION = 1
+
+# Maximum amount of edge data kept in a single cache file, in bytes
+MAX_BYTES = 64 * 1024 * 1024
+
+
+class EdgeCache:
+    '''
+    EdgeCache remembers the size and edges of every texture in a directory,
+    so that textures which have not changed do not need to be decoded again.
+
+    The cache is stored in a file named '.texstitch-cache' in that directory.
+    Entries are keyed by filename and are only used if the file's size and
+    modification time still match. Once the cache holds more than max_bytes
+    of edge data, the least recently used entries are evicted.
+
+    path      - directory this cache belongs to
+    max_bytes - maximum amount of edge data to keep
+    entries   - cache entries, least recently used first
+    order     - names of the entries in the order they were last saved in
+    '''
+    path = ""
+    max_bytes = MAX_BYTES
+    entries = None
+    order = None
+    nbytes = 0
+    changed = False
+
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.load()
+
+    def get_cache_path(self):
+        return os.path.join(self.path, CACHE_NAME)
+
+    def load(self):
+        '''
+        Load this cache from disk. A missing or unreadable cache file is
+        treated as an empty cache.
+        '''
+        try:
+            with open(self.get_cache_path(), 'r') as fh:
+                jdata = json.loads(fh.read())
+            if jdata["version"] != CACHE_VERSION:
+                return
+            for name, entry in jdata["entries"]:
+                edges = tuple(base64.b64decode(e) for e in entry["edges"])
+                self.add_entry(name, entry["size"], entry["mtime"],
+                               entry["width"], entry["height"], edges)
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries.clear()
+            self.nbytes = 0
+        self.order = list(self.entries)
+        self.changed = False
+
+    def save(self):
+        '''
+        Write this cache to disk if it has changed. Cache hits only reorder
+        the entries, so the cache is also written if that order differs from
+        the saved one, otherwise recently used entries would still be evicted
+        first by later runs.
+        '''
+        if not self.changed and list(self.entries) == self.order:
+            return
+        entries = [
+            [name, {
+                "size": size,
+                "mtime": mtime,
+                "width": width,
+                "height": height,
+                "edges": [base64.b64encode(e).decode('ascii') for e in edges],
+            }]
+            for name, (size, mtime, width, height, edges)
+            in self.entries.items()
+        ]
+        data = {
+            "version": CACHE_VERSION,
+            "entries": entries,
+        }
+        fname = self.get_cache_path()
+        tmpname = fname + ".tmp"
+        with open(tmpname, 'w') as fh:
+            fh.write(json.dumps(data))
+        os.replace(tmpname, fname)
+        self.order = list(self.entries)
+        self.changed = False
+
+    def add_entry(self, name, size, mtime, width, height, edges):
+        if name in self.entries:
+            self.remove_entry(name)
+        self.entries[name] = (size, mtime, width, height, edges)
+        self.nbytes += sum(len(e) for e in edges)
+        self.changed = True
+        # Evict least recently used entries
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.remove_entry(next(iter(self.entries)))
+
+    def remove_entry(self, name):
+        edges = self.entries.pop(name)[4]
+        self.nbytes -= sum(len(e) for e in edges)
+        self.changed = True
+
+    def get(self, fname, stat):
+        '''
+        Get the cached size and edges of a file
+
+        fname - name of file
+        stat  - result of os.stat on the file
+
+        Returns (width, height, edges), or None if the file is not cached or
+        has changed since it was cached.
+        '''
+        name = os.path.basename(fname)
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        size, mtime, width, height, edges = entry
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            self.remove_entry(name)
+            return None
+        self.entries.move_to_end(name)
+        return width, height, edges
+
+    def put(self, fname, stat, width, height, edges):
+        '''
+        Cache the size and edges of a file
+
+        fname - name of file
+        stat  - result of os.stat on the file, taken before it was decoded
+        '''
+        self.add_entry(os.path.basename(fname), stat.st_size,
+                       stat.st_mtime_ns, width, height, edges)
+
+
+class EdgeCacheSet:
+    '''
+    EdgeCacheSet keeps one EdgeCache for each directory that textures are
+    loaded from
+    '''
+    caches = None
+
+    def __init__(self):
+        self.caches = {}
+
+    def get_cache(self, fname):
+        path = os.path.dirname(os.path.abspath(fname))
+        cache = self.caches.get(path)
+        if cache is None:
+            cache = EdgeCache(path)
+            self.caches[path] = cache
+        return cache
+
+    def get(self, fname, stat):
+        return self.get_cache(fname).get(fname, stat)
+
+    def put(self, fname, stat, width, height, edges):
+        self.get_cache(fname).put(fname, stat, width, height, edges)
+
+    def save(self):
+        '''
+        Write every cache that has changed. Caches that can not be written,
+        such as in read-only directories, are skipped.
+        '''
+        for cache in self.caches.values():
+            try:
+                cache.save()
+            except OSError as e:
+                print("Could not write cache {}: {}"
+                      .format(cache.get_cache_path(), e))
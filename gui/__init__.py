@@ -11,6 +11,8 @@ from gui import newstitchfile
 from gui import newautostitch
 from gui import dataconfig
 from gui import importtex
+from gui import render
+from gui import progress
 
 ZOOM_STAGES = [0.125, 0.25, 0.5, 1, 2, 4, 8]
 
@@ -47,10 +49,12 @@ class StitchGui(ttk.Frame):
     data = None
     default_path = ""
     updated = False
-    img = None
+    composite = None
+    chunks = None
+    chunks_queued = False
     select_index = 0
-    image_full = None
-    image_select = None
+    select_item = None
+    select_images = None
     elements_to_gray = None
     canvas = None
     xscroll = None
@@ -61,6 +65,8 @@ class StitchGui(ttk.Frame):
         super().__init__(root)
         self.default_path = default_path
         self.elements_to_gray = []
+        self.chunks = {}
+        self.select_images = {}
         self.f_init_ui()
 
     def get_default_path(self):
@@ -72,6 +78,8 @@ class StitchGui(ttk.Frame):
         for child in self.mainframe.winfo_children():
             child.destroy()
         self.canvas = None
+        self.select_item = None
+        self.chunks.clear()
         self.refresh_data_panel()
 
     def set_data(self, data):
@@ -79,10 +87,9 @@ class StitchGui(ttk.Frame):
         Set the data to a new value, resetting certain variables in the process
         """
         self.data = data
-        self.image_full = None
-        self.image_select = None
+        self.composite = None
+        self.select_images.clear()
         self.updated = False
-        self.img = None
         self.select_index = -1
         self.zoom = BASE_ZOOM
         state = tk.NORMAL
@@ -108,17 +115,25 @@ class StitchGui(ttk.Frame):
         Updates the given canvas
         """
         self.select_index = value
-        canvas.delete("all")
         ix = value % self.data.width
         iy = value // self.data.width
         x = ix * self.data.tex_width
         y = iy * self.data.tex_height
-        img = self.image_full
-        canvas.create_image(img.width()/2, img.height()/2, image=img)
-        sel = self.image_select
         zoom = ZOOM_STAGES[self.zoom]
-        canvas.create_image(sel.width()/2+x*zoom, sel.height()/2+y*zoom,
-                            image=sel)
+        canvas.coords(self.select_item, x*zoom, y*zoom)
+
+    def get_select_image(self):
+        """
+        Get the selection box at the current zoom, only creating it the first
+        time that zoom is shown
+        """
+        zoom = ZOOM_STAGES[self.zoom]
+        size = (int(zoom*self.data.tex_width), int(zoom*self.data.tex_height))
+        image = self.select_images.get(size)
+        if image is None:
+            image = create_selection_box(*size)
+            self.select_images[size] = image
+        return image
 
     def bind_select_index(self, event):
         """
@@ -144,50 +159,144 @@ class StitchGui(ttk.Frame):
 
     def refresh_data_panel(self):
         """
-        Refresh the currently displayed image
+        Refresh the currently displayed image, stitching every texture again
+        in the background
         """
+        self.composite = None
         if self.data is None:
             for child in self.mainframe.winfo_children():
                 child.destroy()
             self.canvas = None
+            self.select_item = None
             return
-        w = self.data.tex_width
-        h = self.data.tex_height
-        # Create image
-        self.img = self.data.get_stitched_image()
+        data = self.data
         zoom = ZOOM_STAGES[self.zoom]
-        mode = Image.NEAREST
-        if zoom < 1:
-            mode = Image.BICUBIC
-        size = (int(zoom*self.img.width), int(zoom*self.img.height))
-        self.img = self.img.transform(
-            size, Image.EXTENT, (0, 0, self.img.width, self.img.height), mode)
-        tkimg = ImageTk.PhotoImage(self.img)
-        self.image_full = tkimg
-        # Create selection image
-        self.image_select = create_selection_box(int(zoom*w), int(zoom*h))
+
+        def work(task):
+            task.progress(0, len(data.texlist), "Stitching textures...")
+            image = data.get_stitched_image(progress=task.progress)
+            return render.Composite(data, zoom, image)
+
+        def done(composite):
+            # The project may have been closed in the meantime
+            if self.data is not data:
+                return
+            self.composite = composite
+            self.show_composite()
+
+        progress.run_task(self.master, "Loading", work, done)
+
+    def show_composite(self):
+        """
+        Show the stitched image at the current zoom
+        """
+        size = self.composite.get_zoomed_size()
+        # The canvas never needs to be larger than the screen
+        view_size = (min(size[0], self.winfo_screenwidth()),
+                     min(size[1], self.winfo_screenheight()))
         # Create canvas
         if self.canvas is None:
             self.canvas = tk.Canvas(
-                self.mainframe, width=size[0], height=size[1],
+                self.mainframe, width=view_size[0], height=view_size[1],
                 scrollregion=(0, 0, size[0], size[1]))
             self.canvas.bind("<Button-1>", self.bind_select_index)
+            self.canvas.bind("<Configure>", self.bind_resize)
             # Create Y scrollbar
             scroll_canvas_y = tk.Scrollbar(
                 self.mainframe, orient=tk.VERTICAL, command=self.canvas.yview)
-            self.canvas["yscrollcommand"] = scroll_canvas_y.set
+            self.canvas["yscrollcommand"] = self.bind_scroll_y
             scroll_canvas_y.pack(side=tk.RIGHT, anchor=tk.N, fill=tk.Y)
             self.yscroll = scroll_canvas_y
             # Create X scrollbar
             scroll_canvas_x = tk.Scrollbar(
                 self.mainframe, orient=tk.HORIZONTAL,
                 command=self.canvas.xview)
-            self.canvas["xscrollcommand"] = scroll_canvas_x.set
+            self.canvas["xscrollcommand"] = self.bind_scroll_x
             scroll_canvas_x.pack(side=tk.BOTTOM, anchor=tk.W, fill=tk.X)
             self.xscroll = scroll_canvas_x
             # Pack canvas
             self.canvas.pack(side=tk.TOP)
+        else:
+            self.canvas.config(width=view_size[0], height=view_size[1],
+                               scrollregion=(0, 0, size[0], size[1]))
+            self.clear_chunks()
+        # The selection is a single item that is only ever moved around
+        if self.select_item is None:
+            self.select_item = self.canvas.create_image(
+                0, 0, anchor=tk.NW, image=self.get_select_image(),
+                tags="select")
+        else:
+            self.canvas.itemconfig(self.select_item,
+                                   image=self.get_select_image())
         # Draw Canvas
+        self.update_chunks()
+        self.set_select_index(self.canvas, self.select_index)
+
+    def bind_scroll_x(self, first, last):
+        self.xscroll.set(first, last)
+        self.queue_update_chunks()
+
+    def bind_scroll_y(self, first, last):
+        self.yscroll.set(first, last)
+        self.queue_update_chunks()
+
+    def bind_resize(self, event):
+        self.queue_update_chunks()
+
+    def queue_update_chunks(self):
+        """
+        Update the chunks once Tk is idle, so that scrolling both ways or
+        several times in a row only updates them once
+        """
+        if not self.chunks_queued:
+            self.chunks_queued = True
+            self.after_idle(self.update_chunks)
+
+    def clear_chunks(self):
+        for item, photo in self.chunks.values():
+            self.canvas.delete(item)
+        self.chunks.clear()
+
+    def update_chunks(self):
+        """
+        Show the chunks of the stitched image that are in view, and drop the
+        ones that are not. Only the shown part of the image is ever made
+        into Tk images.
+        """
+        self.chunks_queued = False
+        if self.canvas is None or self.composite is None:
+            return
+        size = self.composite.get_zoomed_size()
+        x = self.canvas.canvasx(0)
+        y = self.canvas.canvasy(0)
+        view = (x, y, x + self.canvas.winfo_width(),
+                y + self.canvas.winfo_height())
+        shown = set(render.get_chunks(size, view))
+        for chunk in list(self.chunks):
+            if chunk not in shown:
+                self.canvas.delete(self.chunks.pop(chunk)[0])
+        for chunk in shown:
+            if chunk in self.chunks:
+                continue
+            box = render.get_chunk_box(chunk, size)
+            photo = ImageTk.PhotoImage(self.composite.get_region(box))
+            item = self.canvas.create_image(box[0], box[1], anchor=tk.NW,
+                                            image=photo, tags="chunk")
+            self.chunks[chunk] = (item, photo)
+        # Keep the selection above the image
+        self.canvas.tag_raise("select")
+
+    def redraw_swapped(self, i, j):
+        """
+        Redraw two cells whose textures were swapped, without stitching the
+        whole image again
+        """
+        boxes = self.composite.swap_cells(i, j)
+        size = self.composite.get_zoomed_size()
+        for chunk, (item, photo) in self.chunks.items():
+            box = render.get_chunk_box(chunk, size)
+            if any(render.boxes_overlap(box, b) for b in boxes):
+                photo.paste(self.composite.get_region(box))
         self.set_select_index(self.canvas, self.select_index)
 
     def check_save(self, should_alert=False):
@@ -265,7 +374,7 @@ class StitchGui(ttk.Frame):
             return
         self.data.path = fname
         self.master.title(EDITOR_NAME + " - " + os.path.basename(fname))
-        if self.data.export_to_json():
+        if self.data.export_to_json(update_index=False):
             mbox.showerror("Error", "Could not save.")
             return True
         else:
@@ -281,7 +390,7 @@ class StitchGui(ttk.Frame):
             mbox.showinfo("Information", "No data to save.")
         if self.check_data_path():
             return True
-        if self.data.export_to_json():
+        if self.data.export_to_json(update_index=False):
             mbox.showerror("Error", "Could not save.")
             return True
         else:
@@ -371,9 +480,32 @@ class StitchGui(ttk.Frame):
             initialdir=self.get_default_path(),
             title="Input image",
             filetypes=util.FILES_IMG)
-        image = Image.open(fname).convert("RGBA")
-        self.data.unpack_image(image)
-        self.refresh_data_panel()
+        if fname == () or fname == "":
+            return
+        data = self.data
+
+        def work(task):
+            task.progress(0, 0, "Reading image...")
+            image = Image.open(fname).convert("RGBA")
+            task.progress(0, len(data.texlist), "Importing textures...")
+            return data.unpack_image(image, util.DEFAULT_JOBS,
+                                     progress=task.progress)
+
+        def done(result):
+            written, errors = result
+            if len(errors) > 0:
+                mbox.showerror(
+                    "Error", "Could not import {} textures:\n{}".format(
+                        len(errors), "\n".join(name for name, e in errors)))
+            self.refresh_data_panel()
+
+        def failed(error):
+            # Some textures may have been written before it stopped
+            if not isinstance(error, progress.Cancelled):
+                mbox.showerror("Error", str(error))
+            self.refresh_data_panel()
+
+        progress.run_task(self.master, "Importing", work, done, failed)
 
     def f_export_whole(self):
         """
@@ -390,10 +522,18 @@ class StitchGui(ttk.Frame):
         if fname == () or fname == "":
             mbox.showerror("Error", "Could not export.")
             return
-        # Create image
-        image = self.data.get_stitched_image()
-        # Save image
-        image.save(fname)
+        data = self.data
+
+        def work(task):
+            task.progress(0, len(data.texlist), "Stitching textures...")
+            # Create image
+            image = data.get_stitched_image(progress=task.progress)
+            # Save image
+            task.progress(len(data.texlist), len(data.texlist),
+                          "Saving image...")
+            image.save(fname)
+
+        progress.run_task(self.master, "Exporting", work)
 
     def f_move_tile_to(self, ifrom, ito):
         """
@@ -411,7 +551,10 @@ class StitchGui(ttk.Frame):
             self.data.texlist[ito], self.data.texlist[ifrom]
         self.select_index = ito
         self.updated = True
-        self.refresh_data_panel()
+        if self.composite is None or self.canvas is None:
+            self.refresh_data_panel()
+        else:
+            self.redraw_swapped(ifrom, ito)
 
     def f_move_up(self, event=None):
         """
@@ -447,14 +590,25 @@ class StitchGui(ttk.Frame):
             return
         self.f_move_tile_to(self.select_index, self.select_index+1)
 
+    def set_zoom(self, zoom):
+        """
+        Set the zoom to an index of ZOOM_STAGES. The stitched image is scaled
+        from the one in memory, no textures are read.
+        """
+        self.zoom = zoom
+        if self.composite is None:
+            self.reset_canvas()
+            return
+        self.composite.set_zoom(ZOOM_STAGES[zoom])
+        self.show_composite()
+
     def f_zoom_in(self):
         """
         Zoom in a little
         """
         if self.zoom + 1 >= len(ZOOM_STAGES):
             return
-        self.zoom += 1
-        self.reset_canvas()
+        self.set_zoom(self.zoom + 1)
 
     def f_zoom_out(self):
         """
@@ -462,8 +616,7 @@ class StitchGui(ttk.Frame):
         """
         if self.zoom - 1 < 0:
             return
-        self.zoom -= 1
-        self.reset_canvas()
+        self.set_zoom(self.zoom - 1)
 
     def f_config(self):
         if dataconfig.config_data(self.master, self.data):
@@ -477,13 +630,27 @@ class StitchGui(ttk.Frame):
             "Choose folder for output folder")
         if folder == "" or folder == ():
             return
-        for i in range(len(self.data.texlist)):
-            fname = self.data.texlist[i]
-            base = os.path.basename(fname)
-            newname = os.path.join(folder, base)
-            shutil.move(fname, newname)
-            self.data.texlist[i] = newname
-        self.updated = True
+        texlist = self.data.texlist
+
+        def work(task):
+            for i in range(len(texlist)):
+                task.progress(i, len(texlist), "Moving textures...")
+                fname = texlist[i]
+                base = os.path.basename(fname)
+                newname = os.path.join(folder, base)
+                shutil.move(fname, newname)
+                texlist[i] = newname
+
+        def done(result):
+            self.updated = True
+
+        def failed(error):
+            # Textures moved before it stopped keep their new names
+            self.updated = True
+            if not isinstance(error, progress.Cancelled):
+                mbox.showerror("Error", str(error))
+
+        progress.run_task(self.master, "Moving textures", work, done, failed)
 
     def f_import_textures(self):
         if self.data is None:
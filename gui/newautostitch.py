@@ -95,9 +95,7 @@ def auto_new_file(root, default_path):
     if not f.ok:
         return None
     data = stitch.StitchData()
-    imgnodes = {}
-    for name in f.texfiles:
-        imgnodes[name] = seams.ImageNode(name)
+    imgnodes = seams.load_image_nodes(f.texfiles, util.DEFAULT_JOBS)
     seams.compare_image_nodes(imgnodes)
     seams.put_nodes_into_data(imgnodes, data)
 
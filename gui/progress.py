@@ -0,0 +1,151 @@
+import threading
+import traceback
+import tkinter as tk
+from tkinter import ttk
+from tkinter import messagebox as mbox
+
+# Milliseconds between checking on a running task
+POLL_MS = 50
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a task once it has been cancelled
+    """
+
+
+class Task:
+    """
+    Task runs a function in a worker thread. The function is given the task,
+    and should call task.progress every so often, which raises Cancelled
+    once the task is cancelled.
+
+    Tk must only be used from the main thread, so the task never touches
+    it. Instead the main thread polls done, total, finished, result and
+    error.
+    """
+    func = None
+    done = 0
+    total = 0
+    message = ""
+    cancelled = False
+    finished = False
+    result = None
+    error = None
+
+    def __init__(self, func):
+        self.func = func
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = self.func(self)
+        except Exception as e:
+            if not isinstance(e, Cancelled):
+                traceback.print_exc()
+            self.error = e
+        self.finished = True
+
+    def progress(self, done, total, message=None):
+        """
+        Report how much of the task is done
+        """
+        self.done = done
+        self.total = total
+        if message is not None:
+            self.message = message
+        if self.cancelled:
+            raise Cancelled()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ProgressDialog(tk.Toplevel):
+    """
+    Shows the progress of a running Task, with a button to cancel it. The
+    window it belongs to takes no input until the task finishes, but keeps
+    drawing itself.
+    """
+    task = None
+    on_done = None
+    on_error = None
+
+    def accept_cancel(self):
+        """
+        Cancel button is pressed
+        """
+        self.task.cancel()
+        self.label.config(text="Cancelling...")
+        self.button_cancel.config(state=tk.DISABLED)
+
+    def poll(self):
+        """
+        Update the progress bar, or hand the result over once the task
+        finished
+        """
+        task = self.task
+        if not task.finished:
+            if task.total > 0:
+                self.progressbar.stop()
+                self.progressbar.config(mode="determinate",
+                                        maximum=task.total, value=task.done)
+            if not task.cancelled:
+                self.label.config(text=task.message)
+            self.after(POLL_MS, self.poll)
+            return
+        self.grab_release()
+        self.destroy()
+        if task.error is None:
+            if self.on_done is not None:
+                self.on_done(task.result)
+        elif self.on_error is not None:
+            self.on_error(task.error)
+        elif not isinstance(task.error, Cancelled):
+            mbox.showerror("Error", str(task.error))
+
+    def __init__(self, parent, title, task, on_done=None, on_error=None):
+        # Init
+        super().__init__(parent)
+        self.title(title)
+        self.geometry("320x100")
+        self.resizable(False, False)
+        self.transient(parent)
+        self.task = task
+        self.on_done = on_done
+        self.on_error = on_error
+        # Progress
+        self.label = tk.Label(self, text=task.message)
+        self.label.pack(fill=tk.X, padx=5, pady=5)
+        self.progressbar = ttk.Progressbar(self, mode="indeterminate")
+        self.progressbar.pack(fill=tk.X, padx=5, pady=5)
+        self.progressbar.start()
+        # Cancel button
+        self.button_cancel = tk.Button(
+            self,
+            text="Cancel",
+            command=self.accept_cancel)
+        self.button_cancel.pack(side=tk.RIGHT, padx=5, pady=5)
+        self.protocol('WM_DELETE_WINDOW', self.accept_cancel)
+        # Keep other windows from changing anything while the task runs
+        self.wait_visibility()
+        self.grab_set()
+        self.after(POLL_MS, self.poll)
+
+
+def run_task(parent, title, func, on_done=None, on_error=None):
+    """
+    Run func(task) in a worker thread while showing its progress.
+
+    on_done  - called with what func returned once it finishes
+    on_error - called with the exception if func raised or was cancelled,
+               by default errors other than Cancelled are shown
+
+    Both are called from the main thread.
+    """
+    task = Task(func)
+    task.start()
+    return ProgressDialog(parent, title, task, on_done, on_error)
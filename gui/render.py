@@ -0,0 +1,241 @@
+import math
+import collections
+from PIL import Image
+
+# Default maximum amount of memory used by the scaled images of a Composite
+MAX_BYTES = 256 * 1024 * 1024
+# Width and height of the pieces the shown image is split into
+CHUNK_SIZE = 256
+
+
+def get_resample(zoom):
+    """
+    Get the filter used to scale the stitched image by zoom
+    """
+    if zoom < 1:
+        return Image.BICUBIC
+    return Image.NEAREST
+
+
+def get_reduce_factor(zoom):
+    """
+    Get n if zoom is 1/n for a whole number n above 1, otherwise None
+    """
+    if zoom >= 1:
+        return None
+    factor = round(1 / zoom)
+    if factor * zoom != 1:
+        return None
+    return factor
+
+
+def get_scaled_size(image, zoom):
+    return (int(zoom*image.width), int(zoom*image.height))
+
+
+def scale_region(image, zoom, box):
+    """
+    Scale the part of an image that ends up in box once the whole image is
+    scaled by zoom. The result is the same as that part of the whole scaled
+    image, without scaling the rest of it.
+
+    Zooming out by 1/n averages each block of n by n pixels, which only
+    depends on the pixels in that block, so any part comes out exactly the
+    same. Other zooms sample the image at the positions that the whole
+    image would be sampled at, which is exact when zooming in by a power of
+    two.
+
+    image - image to scale
+    zoom  - scale of the whole scaled image
+    box   - (left, top, right, bottom) in the scaled image
+    """
+    factor = get_reduce_factor(zoom)
+    if factor is not None:
+        source = tuple(v * factor for v in box)
+        return image.crop(source).reduce(factor)
+    size = get_scaled_size(image, zoom)
+    sx = image.width / size[0]
+    sy = image.height / size[1]
+    extent = (box[0]*sx, box[1]*sy, box[2]*sx, box[3]*sy)
+    return image.transform((box[2]-box[0], box[3]-box[1]), Image.EXTENT,
+                           extent, get_resample(zoom))
+
+
+class Composite:
+    """
+    Composite keeps a project's stitched image in memory, along with a
+    pyramid of the image scaled by each zoom that was shown, so that zooming
+    and moving textures around never have to stitch every texture again.
+
+    Scaled images are only made once they are shown. Once they take more
+    than max_bytes, the least recently shown ones are dropped, apart from
+    the current one. Zooming in would make images far larger than the
+    stitched one, so those are never kept; only the shown regions are
+    scaled, see get_region.
+
+    data      - StitchData being shown
+    image     - stitched image at full size
+    zoom      - scale of the shown image
+    zoomed    - stitched image scaled by zoom, or None when zoomed in
+    levels    - scaled images keyed by zoom, least recently shown first
+    max_bytes - maximum amount of memory used by levels
+    """
+    data = None
+    image = None
+    zoom = 1
+    zoomed = None
+    levels = None
+    max_bytes = MAX_BYTES
+
+    def __init__(self, data, zoom, image=None, max_bytes=MAX_BYTES):
+        self.data = data
+        if image is None:
+            image = data.get_stitched_image()
+        self.image = image
+        self.levels = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.set_zoom(zoom)
+
+    def get_zoomed_size(self, zoom=None):
+        if zoom is None:
+            zoom = self.zoom
+        return get_scaled_size(self.image, zoom)
+
+    def get_level(self, zoom):
+        """
+        Get the stitched image scaled by zoom, scaling it if it isn't in the
+        pyramid yet
+        """
+        level = self.levels.get(zoom)
+        if level is not None:
+            self.levels.move_to_end(zoom)
+            return level
+        size = self.get_zoomed_size(zoom)
+        if zoom == 1:
+            # The full size image is used as is
+            level = self.image
+        elif size[0] == 0 or size[1] == 0:
+            level = Image.new('RGBA', size)
+        else:
+            level = scale_region(self.image, zoom, (0, 0) + size)
+        self.levels[zoom] = level
+        return level
+
+    def evict(self):
+        """
+        Drop the least recently shown levels until the pyramid fits in
+        max_bytes, always keeping the current level
+        """
+        nbytes = sum(get_image_bytes(level) for level in self.levels.values()
+                     if level is not self.image)
+        for zoom in list(self.levels):
+            if nbytes <= self.max_bytes:
+                break
+            level = self.levels[zoom]
+            if zoom == self.zoom or level is self.image:
+                continue
+            del self.levels[zoom]
+            nbytes -= get_image_bytes(level)
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.zoomed = None
+        if zoom <= 1:
+            self.zoomed = self.get_level(zoom)
+        self.evict()
+
+    def get_region(self, box):
+        """
+        Get a box of the stitched image scaled by the current zoom
+        """
+        if self.zoomed is None:
+            return scale_region(self.image, self.zoom, box)
+        return self.zoomed.crop(box)
+
+    def get_cell_box(self, i):
+        """
+        Get the box of the full size image covered by the i-th texture
+        """
+        x, y = self.data.get_tile_pos(i)
+        return (x, y, x + self.data.tex_width, y + self.data.tex_height)
+
+    def get_zoomed_box(self, box, size=None):
+        """
+        Get the box of an image scaled to size that changes when the given
+        box of the full size image changes, by default at the current zoom
+        """
+        if size is None:
+            size = self.get_zoomed_size()
+        sx = size[0] / self.image.width
+        sy = size[1] / self.image.height
+        # Sampling may reach a little past the box, so one more pixel on
+        # each side is redrawn
+        return (max(0, math.floor(box[0]*sx) - 1),
+                max(0, math.floor(box[1]*sy) - 1),
+                min(size[0], math.ceil(box[2]*sx) + 1),
+                min(size[1], math.ceil(box[3]*sy) + 1))
+
+    def update_box(self, box):
+        """
+        Redraw every level of the pyramid after the given box of the full
+        size image changed
+
+        Returns the box of the current level that was redrawn
+        """
+        for zoom, level in self.levels.items():
+            if level is self.image:
+                continue
+            zbox = self.get_zoomed_box(box, level.size)
+            if zbox[0] < zbox[2] and zbox[1] < zbox[3]:
+                level.paste(scale_region(self.image, zoom, zbox), zbox[:2])
+        return self.get_zoomed_box(box)
+
+    def swap_cells(self, i, j):
+        """
+        Swap the pixels of two cells, after their textures were swapped in
+        texlist. No textures are read.
+
+        Returns the boxes of the current level that were redrawn
+        """
+        box_i = self.get_cell_box(i)
+        box_j = self.get_cell_box(j)
+        cell_i = self.image.crop(box_i)
+        self.image.paste(self.image.crop(box_j), box_i[:2])
+        self.image.paste(cell_i, box_j[:2])
+        return [self.update_box(box_i), self.update_box(box_j)]
+
+
+def get_image_bytes(image):
+    return image.width * image.height * 4
+
+
+def get_chunks(size, view, margin=1):
+    """
+    Get the chunks of an image that are in view, along with margin more
+    chunks on each side so that scrolling a little shows them right away
+
+    size - size of the image
+    view - (left, top, right, bottom) of the shown part of the image
+
+    Returns (column, row) of each chunk
+    """
+    columns = math.ceil(size[0] / CHUNK_SIZE)
+    rows = math.ceil(size[1] / CHUNK_SIZE)
+    x1 = max(0, math.floor(view[0] / CHUNK_SIZE) - margin)
+    y1 = max(0, math.floor(view[1] / CHUNK_SIZE) - margin)
+    x2 = min(columns, math.ceil(view[2] / CHUNK_SIZE) + margin)
+    y2 = min(rows, math.ceil(view[3] / CHUNK_SIZE) + margin)
+    return [(x, y) for y in range(y1, y2) for x in range(x1, x2)]
+
+
+def get_chunk_box(chunk, size):
+    """
+    Get the box of an image covered by a chunk
+    """
+    x = chunk[0] * CHUNK_SIZE
+    y = chunk[1] * CHUNK_SIZE
+    return (x, y, min(size[0], x + CHUNK_SIZE), min(size[1], y + CHUNK_SIZE))
+
+
+def boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
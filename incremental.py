@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+
+from PIL import Image
+import timing
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 2
+
+
+def get_manifest_path(fname):
+    '''
+    Get the filename of the manifest kept alongside a packed image
+    '''
+    return fname + MANIFEST_SUFFIX
+
+
+def load_manifest(fname):
+    '''
+    Load the manifest of a packed image
+
+    fname - filename of packed image
+
+    Returns None if there is no usable manifest
+    '''
+    try:
+        with open(get_manifest_path(fname), 'r') as fh:
+            manifest = json.loads(fh.read())
+        if manifest["version"] != MANIFEST_VERSION:
+            return None
+        # Texture paths are relative to the manifest
+        path = os.path.dirname(os.path.abspath(fname))
+        for cell in manifest["cells"]:
+            if cell is not None:
+                cell["file"] = os.path.abspath(
+                    os.path.join(path, cell["file"]))
+        return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_manifest(fname, data, cells):
+    '''
+    Save the manifest of a packed image
+
+    fname - filename of packed image, which must already be written
+    data  - StitchData the image was packed from
+    cells - for each tile, the "file", "mtime" and "size" of its texture
+            and the "hash" of the tile's pixels, or None if the texture
+            could not be read
+    '''
+    path = os.path.dirname(os.path.abspath(fname))
+    stat = os.stat(fname)
+    outcells = []
+    for cell in cells:
+        if cell is not None:
+            cell = dict(cell)
+            cell["file"] = os.path.relpath(cell["file"], path)
+        outcells.append(cell)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "width": data.width,
+        "tex_width": data.tex_width,
+        "tex_height": data.tex_height,
+        "image_mtime": stat.st_mtime_ns,
+        "image_size": stat.st_size,
+        "cells": outcells,
+    }
+    with open(get_manifest_path(fname), 'w') as fh:
+        fh.write(json.dumps(manifest, indent=4, sort_keys=True))
+
+
+def is_manifest_usable(manifest, data, fname):
+    '''
+    Check that a manifest describes a packed image that can be patched:
+    the image must not have been modified since, and must have been packed
+    with the same layout as data
+    '''
+    if manifest is None:
+        return False
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return False
+    return stat.st_mtime_ns == manifest["image_mtime"] and\
+        stat.st_size == manifest["image_size"] and\
+        manifest["width"] == data.width and\
+        manifest["tex_width"] == data.tex_width and\
+        manifest["tex_height"] == data.tex_height and\
+        len(manifest["cells"]) == len(data.texlist)
+
+
+def get_unchanged_cell(cell, fname):
+    '''
+    Check if a tile still shows its texture without decoding the texture
+
+    cell  - the tile's manifest entry, or None
+    fname - texture currently meant to be in the tile
+
+    Returns the tile's manifest entry if its texture's file is unchanged,
+    otherwise None
+    '''
+    if cell is None:
+        return None
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    if cell["file"] == fname and stat.st_mtime_ns == cell["mtime"] and\
+            stat.st_size == cell["size"]:
+        return cell
+    return None
+
+
+def get_cell(fname):
+    '''
+    Get the manifest entry of a tile that is about to be loaded from a
+    texture, without its hash
+
+    Returns None if the texture does not exist
+    '''
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return {"file": fname, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def get_tile_hash(tile):
+    '''
+    Hash the pixel data of an RGBA tile
+    '''
+    with timing.phase("hash"):
+        return hashlib.sha1(tile.tobytes()).hexdigest()
+
+
+def pack_incremental(data, fname, jobs=1):
+    '''
+    Pack a StitchData's textures into an image, only decoding the tiles
+    whose texture's file changed since the image was last packed this way,
+    and only pasting those whose pixels changed. A manifest of which texture
+    is in each tile, and a hash of the tile, is kept alongside the image. If
+    there is no usable manifest, the whole image is packed.
+
+    data  - StitchData to pack
+    fname - filename of packed image
+    jobs  - number of textures to decode at the same time
+
+    Returns (number of tiles that were pasted, total number of tiles)
+    '''
+    manifest = load_manifest(fname)
+    image = None
+    if is_manifest_usable(manifest, data, fname):
+        try:
+            image = Image.open(fname).convert("RGBA")
+            old_cells = manifest["cells"]
+        except IOError:
+            image = None
+    if image is None or image.size != (data.get_img_width(),
+                                       data.get_img_height()):
+        image = Image.new('RGBA', (data.get_img_width(),
+                                   data.get_img_height()), (0, 0, 0, 255))
+        old_cells = [None] * len(data.texlist)
+    # Find tiles whose texture's file changed
+    cells = []
+    load = []
+    for i, texname in enumerate(data.texlist):
+        cell = get_unchanged_cell(old_cells[i], texname)
+        cells.append(cell)
+        if cell is None:
+            load.append(i)
+    # Files are checked before they are decoded, so that a texture written
+    # in between is seen as changed the next time
+    for i in load:
+        cells[i] = get_cell(data.texlist[i])
+    # Decode them through tilecache.shared, and paste the ones whose pixels
+    # changed. Textures that were moved or touched keep their tile.
+    black = Image.new('RGBA', (data.tex_width, data.tex_height),
+                      (0, 0, 0, 255))
+    changed = 0
+    for i, tile in data.iter_tiles(indices=load, jobs=jobs):
+        if tile is None:
+            tile = black
+            cells[i] = None
+        else:
+            tile_hash = get_tile_hash(tile)
+            if cells[i] is not None:
+                cells[i]["hash"] = tile_hash
+            old = old_cells[i]
+            if old is not None and old.get("hash") == tile_hash:
+                continue
+        with timing.phase("paste"):
+            image.paste(tile, data.get_tile_pos(i))
+        changed += 1
+    if changed > 0 or not os.path.exists(fname):
+        with timing.phase("save"):
+            image.save(fname)
+        save_manifest(fname, data, cells)
+    elif any(cell is not old for cell, old in zip(cells, old_cells)):
+        # Textures were moved or touched without changing the image
+        save_manifest(fname, data, cells)
+    return changed, len(data.texlist)
@@ -0,0 +1,93 @@
+import zlib
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Compressed data is written out in IDAT chunks of about this size
+CHUNK_SIZE = 256 * 1024
+
+
+class PngWriter:
+    '''
+    PngWriter writes an RGBA PNG file a strip of rows at a time, so that the
+    whole image never has to be in memory at once.
+
+    Rows are not filtered, so files may be somewhat larger than the ones
+    Pillow writes.
+
+    fh     - binary file to write to
+    width  - width of image
+    height - height of image
+    level  - zlib compression level
+    '''
+    fh = None
+    width = 0
+    height = 0
+    rows_written = 0
+    compressor = None
+    buffer = None
+    buffer_size = 0
+
+    def __init__(self, fh, width, height, level=6):
+        if width <= 0 or height <= 0:
+            raise ValueError("PNG images can not be empty")
+        self.fh = fh
+        self.width = width
+        self.height = height
+        self.compressor = zlib.compressobj(level)
+        self.buffer = []
+        self.buffer_size = 0
+        fh.write(PNG_SIGNATURE)
+        # 8 bits per channel, color type 6 (RGBA), no interlacing
+        self.write_chunk(b'IHDR', struct.pack(
+            ">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def write_chunk(self, kind, data):
+        self.fh.write(struct.pack(">I", len(data)))
+        self.fh.write(kind)
+        self.fh.write(data)
+        self.fh.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write_compressed(self, data):
+        if len(data) == 0:
+            return
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer_size > 0:
+            self.write_chunk(b'IDAT', b''.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def write_rows(self, image):
+        '''
+        Write the next rows of the image
+
+        image - RGBA image as wide as the output containing the rows
+        '''
+        if image.mode != "RGBA" or image.width != self.width:
+            raise ValueError("Rows must be RGBA and {} pixels wide"
+                             .format(self.width))
+        if self.rows_written + image.height > self.height:
+            raise ValueError("Too many rows written")
+        data = image.tobytes()
+        stride = self.width * 4
+        for y in range(image.height):
+            # Every row starts with its filter type, 0 meaning no filter
+            row = data[y*stride:(y+1)*stride]
+            self.write_compressed(self.compressor.compress(b'\x00' + row))
+        self.rows_written += image.height
+
+    def close(self):
+        '''
+        Finish writing the image. Every row must have been written.
+        '''
+        if self.rows_written != self.height:
+            raise ValueError("Expected {} rows, only {} were written"
+                             .format(self.height, self.rows_written))
+        self.write_compressed(self.compressor.flush())
+        self.flush()
+        self.write_chunk(b'IEND', b'')
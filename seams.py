@@ -1,11 +1,30 @@
 import os
 import sys
+import json
 import shutil
-import itertools
+import fnmatch
 
 from PIL import Image
-from tkinter import filedialog as tk_fd
 import util
+import timing
+import stitch
+import edgecache
+
+
+# Sections with at most this many pixels are compared pixel by pixel. See
+# benchmarks/bench_img_cmp.py
+PIXEL_CMP_MAX = 48
+
+
+def get_strip(image, pos, size):
+    '''
+    Get the raw pixel data of a section of an image
+
+    pos  - top-left position of the section
+    size - size of the section
+    '''
+    box = (pos[0], pos[1], pos[0]+size[0], pos[1]+size[1])
+    return image.crop(box).tobytes()
 
 
 def img_cmp(img1, img2, pos1, pos2, size):
@@ -20,6 +39,18 @@ def img_cmp(img1, img2, pos1, pos2, size):
     area of img1 whose top-left position is (0, 0) with a 4x4 area of img2
     whose top-left position is (6, 6)
     '''
+    if img1.mode != img2.mode or size[0]*size[1] <= PIXEL_CMP_MAX:
+        # Raw pixel data is only comparable between images of the same mode,
+        # and cropping costs more than it saves for very small sections
+        return img_cmp_pixels(img1, img2, pos1, pos2, size)
+    return get_strip(img1, pos1, size) == get_strip(img2, pos2, size)
+
+
+def img_cmp_pixels(img1, img2, pos1, pos2, size):
+    '''
+    Same as img_cmp, but compares the images one pixel at a time. This is much
+    slower, but works for images that have different modes.
+    '''
     px1 = img1.load()
     px2 = img2.load()
     for ix in range(size[0]):
@@ -31,62 +62,105 @@ def img_cmp(img1, img2, pos1, pos2, size):
     return True
 
 
-class ImageNode:
+EDGE_LEFT = 0
+EDGE_RIGHT = 1
+EDGE_TOP = 2
+EDGE_BOTTOM = 3
+
+# Pairs of (edge of a node, edge of its neighbour that must match)
+EDGE_PAIRS = ((EDGE_LEFT, EDGE_RIGHT), (EDGE_RIGHT, EDGE_LEFT),
+              (EDGE_TOP, EDGE_BOTTOM), (EDGE_BOTTOM, EDGE_TOP))
+
+
+def get_edges(image):
+    '''
+    Get the raw pixel data of the 1px strips along each edge of an image
+
+    Returns a tuple indexed by EDGE_LEFT, EDGE_RIGHT, EDGE_TOP and
+    EDGE_BOTTOM. Two images share a seam if the matching strips are equal.
+    '''
+    w = image.width
+    h = image.height
+    size_h = (1, h)  # 1px vertical line
+    size_w = (w, 1)  # 1px horizontal line
+    return (
+        get_strip(image, (0, 0), size_h),
+        get_strip(image, (w-1, 0), size_h),
+        get_strip(image, (0, 0), size_w),
+        get_strip(image, (0, h-1), size_w),
+    )
+
+
+class EdgeNode:
     '''
-    ImageNode represents how an image may be connected with other images
+    EdgeNode represents how an image may be connected with other images.
+    Only the image's size and edges are kept, not the image itself.
 
     fname - filename of node
     used - whether this node has been used
-    image - This node's image data
-    top - ImageNode on top of this node
-    left - ImageNode to left of this node
-    right - ImageNode to right of this node
-    bottom - ImageNode on bottom of this node
-    '''
-    left = None
-    right = None
-    top = None
-    bottom = None
-    image = None
-    fname = ""
-    used = False
+    width - width of this node's image
+    height - height of this node's image
+    edges - This node's edge strips, as returned by get_edges
+    top - EdgeNode on top of this node
+    left - EdgeNode to left of this node
+    right - EdgeNode to right of this node
+    bottom - EdgeNode on bottom of this node
+    '''
+    __slots__ = ("fname", "used", "width", "height", "edges",
+                 "top", "left", "right", "bottom")
 
-    def __init__(self, fname):
+    def __init__(self, fname, width, height, edges):
         self.fname = fname
-        self.image = Image.open(fname).convert("RGBA")
+        self.used = False
+        self.width = width
+        self.height = height
+        self.edges = edges
+        self.top = None
+        self.left = None
+        self.right = None
+        self.bottom = None
 
-    def get_topleft(self, x=0):
+    def get_topleft(self):
         '''
-        Traverses through ImageNodes to get the upper-left most ImageNode
+        Traverses through EdgeNodes to get the upper-left most EdgeNode
         '''
-        if x > 100:
-            return self
-        if self.left is not None:
-            return self.left.get_topleft(x+1)
-        if self.top is not None:
-            return self.top.get_topleft(x+1)
-        return self
-
-    def get_width(self, first=None):
+        node = self
+        # Stop if the links go around in a circle
+        visited = set()
+        while node not in visited:
+            visited.add(node)
+            if node.left is not None:
+                node = node.left
+            elif node.top is not None:
+                node = node.top
+            else:
+                break
+        return node
+
+    def get_width(self):
         '''
         Returns how many nodes are to the right of this node including this
         node
         '''
-        if first is None:
-            first = self
-        if self.right is None or self.right == first:
-            return 1
-        return self.right.get_width(first) + 1
+        node = self
+        # Stop if the links go around in a circle
+        visited = set()
+        while node is not None and node not in visited:
+            visited.add(node)
+            node = node.right
+        return len(visited)
 
-    def get_height(self, first=None):
+    def get_height(self):
         '''
         Returns how many nodes below this node including this node
         '''
-        if first is None:
-            first = self
-        if self.bottom is None or self.bottom == first:
-            return 1
-        return self.bottom.get_height(first) + 1
+        node = self
+        # Stop if the links go around in a circle
+        visited = set()
+        while node is not None and node not in visited:
+            visited.add(node)
+            node = node.bottom
+        return len(visited)
 
     def compare(self, other):
         '''
@@ -94,27 +168,19 @@ class ImageNode:
         are oriented with each other
         '''
         # Error if nodes have different sizes
-        if self.image.height != other.image.height\
-                or self.image.width != other.image.width:
+        if self.height != other.height or self.width != other.width:
             print("Error! Size mismatch: {} and {}"
                   .format(self.fname, other.fname))
             sys.exit()
-        w = self.image.width
-        h = self.image.height
-        pos_base = (0, 0)      # top-left corner
-        pos_right = (w-1, 0)   # top-right corner
-        pos_bottom = (0, h-1)  # bottom-left corner
-        size_h = (1, h)  # 1px vertical line
-        size_w = (w, 1)  # 1px horizontal line
         # other | self
-        if img_cmp(self.image, other.image, pos_base, pos_right, size_h):
+        if self.edges[EDGE_LEFT] == other.edges[EDGE_RIGHT]:
             if (self.left is not None and self.left != other) or\
                     (other.right is not None and other.right != self):
                 print("OOP LEFT")
             self.left = other
             other.right = self
         # self | other
-        if img_cmp(self.image, other.image, pos_right, pos_base, size_h):
+        if self.edges[EDGE_RIGHT] == other.edges[EDGE_LEFT]:
             if (self.right is not None and self.right != other) or\
                     (other.left is not None and other.left != self):
                 print("OOP RIGHT")
@@ -123,7 +189,7 @@ class ImageNode:
         #  other
         # -------
         #   self
-        if img_cmp(self.image, other.image, pos_base, pos_bottom, size_w):
+        if self.edges[EDGE_TOP] == other.edges[EDGE_BOTTOM]:
             if (self.top is not None and self.top != other) or\
                     (other.bottom is not None and other.bottom != self):
                 print("OOP BOTTOM")
@@ -132,7 +198,7 @@ class ImageNode:
         #   self
         # -------
         #  other
-        if img_cmp(self.image, other.image, pos_bottom, pos_base, size_w):
+        if self.edges[EDGE_BOTTOM] == other.edges[EDGE_TOP]:
             if (self.bottom is not None and self.bottom != other) or\
                     (other.top is not None and other.top != self):
                 print("OOP TOP")
@@ -140,11 +206,168 @@ class ImageNode:
             other.top = self
 
 
+class ImageNode(EdgeNode):
+    '''
+    ImageNode is an EdgeNode that also keeps its image
+
+    image - This node's image data
+    '''
+
+    def __init__(self, fname):
+        image = Image.open(fname).convert("RGBA")
+        super().__init__(fname, image.width, image.height, get_edges(image))
+        self.image = image
+
+
+def load_edge_node(fname):
+    '''
+    Create an EdgeNode from a file. The decoded image is dropped as soon as
+    its edges have been extracted.
+    '''
+    with timing.phase("open"):
+        image = Image.open(fname)
+        image.load()
+    with timing.phase("convert"):
+        image = image.convert("RGBA")
+    with timing.phase("edges"):
+        edges = get_edges(image)
+    return EdgeNode(fname, image.width, image.height, edges)
+
+
+def partition_nodes(imgnodes):
+    '''
+    Split nodes into groups of nodes that have the same size
+
+    Returns a dict of lists of nodes keyed by (width, height), in the order
+    that each size first appears in imgnodes
+    '''
+    buckets = {}
+    for node in imgnodes.values():
+        buckets.setdefault((node.width, node.height), []).append(node)
+    return buckets
+
+
 def compare_image_nodes(imgnodes):
-    for k1, k2 in itertools.combinations(imgnodes, 2):
-        n1 = imgnodes[k1]
-        n2 = imgnodes[k2]
-        n1.compare(n2)
+    '''
+    Link together every pair of nodes that share a seam. Only nodes of the
+    same size are compared with each other.
+    '''
+    for nodes in partition_nodes(imgnodes).values():
+        compare_bucket(nodes)
+
+
+def compare_bucket(nodes):
+    '''
+    Link together every pair of nodes in a list of same sized nodes that share
+    a seam
+
+    Rather than comparing every pair of nodes, each node's edges are put into
+    an index so that neighbours can be looked up directly. Pairs are still
+    compared in the same order as itertools.combinations would, so the
+    resulting links are the same.
+    '''
+    with timing.phase("edge compare"):
+        # Index every edge by its pixel data
+        index = ({}, {}, {}, {})
+        for i, node in enumerate(nodes):
+            for edge in range(4):
+                index[edge].setdefault(node.edges[edge], []).append(i)
+        # Compare each node only with the later nodes it shares an edge with
+        for i, node in enumerate(nodes):
+            matches = set()
+            for edge, other_edge in EDGE_PAIRS:
+                for j in index[other_edge].get(node.edges[edge], ()):
+                    if j > i:
+                        matches.add(j)
+            for j in sorted(matches):
+                node.compare(nodes[j])
+
+
+def load_image_nodes(fnames, jobs=1, processes=False, use_cache=True):
+    '''
+    Create an EdgeNode for each file, decoding several files at once
+
+    fnames    - filenames of textures to load, may be any iterable. Decoding
+                starts while it is still being iterated over.
+    jobs      - number of textures to decode at the same time
+    processes - decode in worker processes instead of threads
+    use_cache - reuse the edges of unchanged textures from the
+                '.texstitch-cache' file next to them, and update that file
+
+    Returns a dict of EdgeNodes keyed by filename, in the same order as
+    fnames. If a texture can not be loaded, the error is raised here just as
+    if it had been loaded on its own.
+    '''
+    pool = None
+    if jobs > 1:
+        pool = util.make_pool(jobs, processes)
+    caches = edgecache.EdgeCacheSet()
+    # Each entry is (filename, stat, node or future)
+    entries = []
+    try:
+        for fname in fnames:
+            stat = None
+            if use_cache:
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    pass
+            # Get unchanged textures from the cache
+            if stat is not None:
+                cached = caches.get(fname, stat)
+                if cached is not None:
+                    entries.append((fname, None, EdgeNode(fname, *cached)))
+                    continue
+            # Decode everything else
+            if pool is None:
+                entries.append((fname, stat, load_edge_node(fname)))
+            else:
+                entries.append((fname, stat,
+                                pool.submit(load_edge_node, fname)))
+        imgnodes = {}
+        for fname, stat, node in entries:
+            if pool is not None and not isinstance(node, EdgeNode):
+                node = node.result()
+            if stat is not None:
+                caches.put(fname, stat, node.width, node.height, node.edges)
+            imgnodes[fname] = node
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    caches.save()
+    return imgnodes
+
+
+def iter_dir_files(path, patterns):
+    '''
+    Iterate over the files in a directory whose names match any of the given
+    glob patterns. The directory is read as it is iterated over.
+
+    path     - directory to search
+    patterns - list of patterns such as '*.png'
+    '''
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            # Don't mistake the edge cache, or one being written, for a
+            # texture
+            if entry.name.startswith(edgecache.CACHE_NAME):
+                continue
+            for pattern in patterns:
+                if fnmatch.fnmatch(entry.name, pattern):
+                    yield os.path.join(path, entry.name)
+                    break
+
+
+def iter_file_list(fh):
+    '''
+    Iterate over a list of filenames, one per line, such as from stdin
+    '''
+    for line in fh:
+        line = line.strip()
+        if line != "":
+            yield line
 
 
 def move_unused_nodes(imgnodes, target):
@@ -161,15 +384,26 @@ def move_unused_nodes(imgnodes, target):
 
 
 def put_nodes_into_data(imgnodes, data):
-    # Get topleft node
-    base_node = next(iter(imgnodes.values())).get_topleft()
+    with timing.phase("graph walk"):
+        # Get topleft node
+        base_node = next(iter(imgnodes.values())).get_topleft()
+        put_grid_into_data(base_node, data)
+
+
+def put_grid_into_data(base_node, data):
+    '''
+    Put a grid of linked nodes into a StitchData
+
+    base_node - upper-left most node of the grid
+    data      - StitchData to put textures into
+    '''
     node = base_node
     width = node.get_width()
     data.width = width
-    data.tex_width = node.image.width-1
-    data.tex_height = node.image.height-1
+    data.tex_width = node.width-1
+    data.tex_height = node.height-1
     # Iterate nodes and put into StitchData
-    while node is not None:
+    while node is not None and not node.used:
         xnode = node
         first_xnode = xnode
         for i in range(0, width):
@@ -177,6 +411,8 @@ def put_nodes_into_data(imgnodes, data):
                 print("Error: Width mismatch, expected {}, got {}"
                       .format(width, i+1))
                 # sys.exit()
+                if xnode is None:
+                    break
             xnode.used = True
             data.texlist.append(xnode.fname)
             xnode = xnode.right
@@ -187,24 +423,172 @@ def put_nodes_into_data(imgnodes, data):
         node = node.bottom
 
 
-def pick_files_auto(data, path):
+def find_grids(nodes):
+    '''
+    Find every connected grid of linked nodes
+
+    nodes - list of nodes that have already been compared
+
+    Returns a list of StitchData, one for each grid. Nodes that aren't linked
+    to any other node are not put into a grid and are left unused.
+    '''
+    grids = []
+    with timing.phase("graph walk"):
+        for node in nodes:
+            if node.used:
+                continue
+            base_node = node.get_topleft()
+            if base_node.used or (base_node.right is None and
+                                  base_node.bottom is None):
+                continue
+            data = stitch.StitchData()
+            put_grid_into_data(base_node, data)
+            grids.append(data)
+    return grids
+
+
+def solve_bucket(nodes):
+    '''
+    Compare a list of same sized nodes and find the grids that they form.
+    This runs in worker processes, so it only returns plain StitchData.
+    '''
+    compare_bucket(nodes)
+    return find_grids(nodes)
+
+
+def auto_stitch_nodes(imgnodes, jobs=1):
+    '''
+    Find every grid of textures with matching seams. Textures are grouped by
+    size, and each group is solved independently.
+
+    imgnodes - nodes to stitch, as returned by load_image_nodes
+    jobs     - number of groups to solve at the same time, each in its own
+               process
+
+    Returns a list of StitchData, one for each grid, ordered by where their
+    first texture appears in imgnodes. Nodes that were put into a grid are
+    marked as used.
+    '''
+    buckets = list(partition_nodes(imgnodes).values())
+    if jobs <= 1 or len(buckets) <= 1:
+        results = map(solve_bucket, buckets)
+    else:
+        with util.make_pool(min(jobs, len(buckets)), processes=True) as pool:
+            results = list(pool.map(solve_bucket, buckets))
+    grids = []
+    for bucket_grids in results:
+        grids.extend(bucket_grids)
+    # Nodes may have been used in another process
+    order = {}
+    for i, fname in enumerate(imgnodes):
+        order[fname] = i
+    for data in grids:
+        for fname in data.texlist:
+            imgnodes[fname].used = True
+    grids.sort(key=lambda data: min(order[f] for f in data.texlist))
+    return grids
+
+
+def write_summary(imgnodes, grids, unused_path, fname):
+    '''
+    Write a json summary of which textures were used by auto stitching
+
+    imgnodes    - nodes that were auto stitched
+    grids       - list of StitchData the nodes were put into
+    unused_path - folder that unused textures were moved to, or None if
+                  they were not moved
+    fname       - file to write the summary to
+    '''
+    summary = {
+        "projects": [data.path for data in grids],
+        "used": [n.fname for n in imgnodes.values() if n.used],
+        "unused": [n.fname for n in imgnodes.values() if not n.used],
+        "unused_path": unused_path,
+    }
+    with open(fname, 'w') as fh:
+        fh.write(json.dumps(summary, indent=4, sort_keys=True))
+
+
+def get_project_names(fname, count):
+    '''
+    Get the filenames to save auto stitched projects to
+
+    fname - filename given by the user, e.g. 'room.json'
+    count - number of projects
+
+    A single project is saved to fname. Several projects are numbered, e.g.
+    'room_1.json', 'room_2.json'.
+    '''
+    if count == 1:
+        return [fname]
+    root, ext = os.path.splitext(fname)
+    return ["{}_{}{}".format(root, i+1, ext) for i in range(count)]
+
+
+def stitch_newseam(path, args):
     '''
-    Automatically pick a bunch of files given that their seams match
-    Any unused textures will be moved to a folder named 'unused_textures'
+    Create new stitch files by automatically matching seams. Textures are
+    grouped by size, and a stitch file is created for every grid of textures
+    that is found.
 
-    data - StitchData to put textures into
-    path - Base path of StitchData
+    args - command line arguments
     '''
-    # Ask for a bunch of files
-    file_path_list = tk_fd.askopenfilenames(
-        filetypes=util.FILES_IMG,
-        initialdir=path,
-        title='Select pictures')
-    # Setup nodes
-    imgnodes = {}
-    for name in file_path_list:
-        imgnodes[name] = ImageNode(name)
-    compare_image_nodes(imgnodes)
-    put_nodes_into_data(imgnodes, data)
-    # Move unused textures into 'unused_textures' folder
-    move_unused_nodes(imgnodes, os.path.join(path, 'unused_textures'))
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    use_cache = not util.pop_flag(args, "--no-cache")
+    directory = util.pop_option(args, "--dir")
+    pattern = util.pop_option(args, "--pattern")
+    use_stdin = util.pop_flag(args, "--stdin")
+    summary = util.pop_option(args, "--summary")
+    # Figure out paths
+    if len(args) != 1:
+        print("Invalid arguments")
+        sys.exit()
+    if directory is not None:
+        directory = os.path.join(path, directory)
+    outfile = os.path.join(path, args[0])
+    path = os.path.dirname(outfile)
+    # Figure out where textures come from
+    if directory is not None and use_stdin:
+        print("Only one of --dir and --stdin may be given")
+        sys.exit()
+    elif directory is not None:
+        if pattern is None:
+            patterns = util.FILES_IMG[0][1]
+        else:
+            patterns = [pattern]
+        file_path_list = iter_dir_files(directory, patterns)
+    elif use_stdin:
+        file_path_list = iter_file_list(sys.stdin)
+    elif pattern is not None:
+        print("--pattern can only be used with --dir")
+        sys.exit()
+    else:
+        from tkinter import filedialog as tk_fd
+        file_path_list = tk_fd.askopenfilenames(
+            filetypes=util.FILES_IMG,
+            initialdir=path,
+            title='Select pictures')
+    # Find grids
+    imgnodes = load_image_nodes(file_path_list, jobs, use_cache=use_cache)
+    if len(imgnodes) == 0:
+        print("No textures were given.")
+        sys.exit()
+    grids = auto_stitch_nodes(imgnodes, jobs)
+    if len(grids) == 0:
+        print("No textures with matching seams were found.")
+    # Output
+    names = get_project_names(outfile, len(grids))
+    for data, name in zip(grids, names):
+        data.path = os.path.abspath(name)
+        data.export_to_json(update_index=False)
+        print("Created file {} with {} textures.".format(
+            name, len(data.texlist)))
+    # Move unused textures into 'unused_textures' folder, unless nothing was
+    # found at all, which more likely means the wrong textures were given
+    unused_path = None
+    if len(grids) > 0:
+        unused_path = os.path.join(path, 'unused_textures')
+    if summary is not None:
+        write_summary(imgnodes, grids, unused_path, summary)
+    if unused_path is not None:
+        move_unused_nodes(imgnodes, unused_path)
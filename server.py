@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import collections
+from http import server
+
+from PIL import Image
+import util
+import seams
+import stitch
+import tilecache
+import incremental
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Default maximum number of projects kept loaded
+MAX_PROJECTS = 32
+
+
+class ProjectCache:
+    '''
+    ProjectCache keeps recently used projects loaded, so that their
+    tile_index stays in memory between requests. A project is loaded again
+    if its file changed since.
+
+    Each project has its own lock, which must be held while it is used.
+
+    max_projects - maximum number of projects to keep loaded
+    projects     - (stat, StitchData, lock) keyed by absolute filename,
+                   least recently used first
+    '''
+    max_projects = MAX_PROJECTS
+    projects = None
+    lock = None
+
+    def __init__(self, max_projects=MAX_PROJECTS):
+        self.max_projects = max_projects
+        self.projects = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, fname):
+        '''
+        Get a project, loading it if needed
+
+        Returns (StitchData, lock)
+        '''
+        fname = os.path.abspath(fname)
+        stat = get_stat(fname)
+        with self.lock:
+            entry = self.projects.get(fname)
+            if entry is not None and entry[0] == stat:
+                self.projects.move_to_end(fname)
+                return entry[1], entry[2]
+        data = stitch.StitchData.import_from_json(fname)
+        with self.lock:
+            # Keep the lock of a project that is already in use
+            entry = self.projects.get(fname)
+            lock = threading.Lock() if entry is None else entry[2]
+            self.projects[fname] = (stat, data, lock)
+            self.projects.move_to_end(fname)
+            while len(self.projects) > self.max_projects:
+                self.projects.popitem(last=False)
+        return data, lock
+
+    def saved(self, data):
+        '''
+        Note that a loaded project was saved, so that it is not loaded again
+        '''
+        fname = os.path.abspath(data.path)
+        with self.lock:
+            entry = self.projects.get(fname)
+            if entry is not None and entry[1] is data:
+                self.projects[fname] = (get_stat(fname), data, entry[2])
+
+    def __len__(self):
+        return len(self.projects)
+
+
+def get_stat(fname):
+    stat = os.stat(fname)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class StitchServer(server.ThreadingHTTPServer):
+    '''
+    StitchServer answers stitch commands sent as JSON over HTTP, keeping
+    projects and decoded tiles in memory between requests
+
+    base_path - path that filenames in requests are relative to
+    jobs      - number of textures to decode or encode at the same time
+    projects  - ProjectCache of loaded projects
+    '''
+    base_path = ""
+    jobs = 1
+    projects = None
+    requests = 0
+    lock = None
+
+    def __init__(self, address, base_path, jobs=1,
+                 max_projects=MAX_PROJECTS):
+        super().__init__(address, RequestHandler)
+        self.base_path = os.path.realpath(base_path)
+        self.jobs = jobs
+        self.projects = ProjectCache(max_projects)
+        self.lock = threading.Lock()
+
+    def count_request(self):
+        # Requests are handled on several threads at once
+        with self.lock:
+            self.requests += 1
+
+    def get_path(self, request, key, required=True):
+        '''
+        Get a filename from a request, relative to base_path
+        '''
+        value = request.get(key)
+        if value is None:
+            if required:
+                raise ValueError("Missing '{}'".format(key))
+            return None
+        return self.resolve_path(value)
+
+    def resolve_path(self, value):
+        '''
+        Resolve a filename relative to base_path. Requests may come from any
+        program that can reach the server, so filenames that lead outside of
+        base_path, including through symlinks, are refused.
+        '''
+        if not isinstance(value, str):
+            raise ValueError("Filenames must be strings")
+        path = os.path.realpath(os.path.join(self.base_path, value))
+        if os.path.commonpath([self.base_path, path]) != self.base_path:
+            raise ValueError("'{}' is outside of the served folder"
+                             .format(value))
+        return path
+
+    def cmd_pack(self, request):
+        '''
+        Pack a project into an image
+
+        project     - project filename
+        image       - image filename
+        incremental - same as pack --incremental
+        stream      - same as pack --stream
+        '''
+        imagename = self.get_path(request, "image")
+        stream = request.get("stream", False)
+        if stream and os.path.splitext(imagename)[1].lower() != ".png":
+            raise ValueError("'stream' can only write PNG images")
+        data, lock = self.projects.get(self.get_path(request, "project"))
+        with lock:
+            if request.get("incremental", False):
+                changed, total = incremental.pack_incremental(
+                    data, imagename, self.jobs)
+                return {"changed": changed, "textures": total}
+            if stream:
+                data.save_stitched_png(imagename, self.jobs)
+            else:
+                data.get_stitched_image(self.jobs).save(imagename)
+            return {"textures": len(data.texlist)}
+
+    def cmd_unpack(self, request):
+        '''
+        Unpack an image into a project's textures
+
+        project - project filename
+        image   - image filename
+        '''
+        data, lock = self.projects.get(self.get_path(request, "project"))
+        image = Image.open(self.get_path(request, "image")).convert("RGBA")
+        with lock:
+            indexed = dict(data.tile_index)
+            written, errors = data.unpack_image(image, self.jobs)
+            if data.version >= 2 and data.tile_index != indexed:
+                data.export_to_json(update_index=False)
+                self.projects.saved(data)
+        return {
+            "written": written,
+            "textures": len(data.texlist),
+            "errors": [[fname, str(e)] for fname, e in errors],
+        }
+
+    def cmd_verify(self, request):
+        '''
+        Find a project's textures that are out of date
+
+        project - project filename
+        image   - image filename, optional
+        '''
+        data, lock = self.projects.get(self.get_path(request, "project"))
+        imagename = self.get_path(request, "image", False)
+        image = None
+        if imagename is not None:
+            image = Image.open(imagename).convert("RGBA")
+        with lock:
+            indexed = len(data.tile_index)
+            found = data.verify(image)
+            if data.version >= 2 and len(data.tile_index) > indexed:
+                data.export_to_json(update_index=False)
+                self.projects.saved(data)
+        return {
+            "outdated": [[fname, reason] for fname, reason in found],
+            "textures": len(data.texlist),
+        }
+
+    def cmd_newseam(self, request):
+        '''
+        Create projects by automatically matching seams
+
+        project     - filename of project to create
+        files       - list of textures, or
+        dir         - folder of textures, with an optional glob 'pattern'
+        use_cache   - whether to use '.texstitch-cache' files, true by
+                      default
+        move_unused - whether to move unused textures into
+                      'unused_textures', false by default
+        '''
+        outfile = self.get_path(request, "project")
+        directory = self.get_path(request, "dir", False)
+        if directory is not None:
+            patterns = util.FILES_IMG[0][1]
+            if "pattern" in request:
+                patterns = [request["pattern"]]
+            fnames = seams.iter_dir_files(directory, patterns)
+        elif "files" in request:
+            fnames = [self.resolve_path(fname) for fname in request["files"]]
+        else:
+            raise ValueError("Missing 'files' or 'dir'")
+        imgnodes = seams.load_image_nodes(
+            fnames, self.jobs, use_cache=request.get("use_cache", True))
+        grids = seams.auto_stitch_nodes(imgnodes, self.jobs)
+        names = seams.get_project_names(outfile, len(grids))
+        for data, name in zip(grids, names):
+            data.path = os.path.abspath(name)
+            data.export_to_json(update_index=False)
+        unused = [n.fname for n in imgnodes.values() if not n.used]
+        if request.get("move_unused", False) and len(grids) > 0:
+            seams.move_unused_nodes(imgnodes, os.path.join(
+                os.path.dirname(outfile), 'unused_textures'))
+        return {
+            "projects": [[data.path, len(data.texlist)] for data in grids],
+            "unused": unused,
+        }
+
+    def get_status(self):
+        return {
+            "projects": len(self.projects),
+            "tiles": len(tilecache.shared.tiles),
+            "tile_bytes": tilecache.shared.nbytes,
+            "requests": self.requests,
+        }
+
+
+# Commands that can be sent to the server, keyed by URL path
+COMMANDS = {
+    "/pack": StitchServer.cmd_pack,
+    "/unpack": StitchServer.cmd_unpack,
+    "/verify": StitchServer.cmd_verify,
+    "/newseam": StitchServer.cmd_newseam,
+}
+
+
+class RequestHandler(server.BaseHTTPRequestHandler):
+    '''
+    Handles a single request to a StitchServer. Commands are sent as a POST
+    to their path with a JSON object as the body. 'GET /status' tells what
+    the server keeps in memory.
+    '''
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": "Not found"})
+            return
+        self.send_json(200, self.server.get_status())
+
+    def do_POST(self):
+        command = COMMANDS.get(self.path)
+        if command is None:
+            self.send_json(404, {"error": "Not a valid command"})
+            return
+        # Web pages can send plain text to the server without asking first,
+        # but not JSON
+        if self.headers.get_content_type() != "application/json":
+            self.send_json(415, {"error": "Requests must be sent as "
+                                          "application/json"})
+            return
+        self.server.count_request()
+        t = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            result = command(self.server, request)
+        except (IOError, ValueError, KeyError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": str(e)})
+            return
+        result["seconds"] = time.perf_counter() - t
+        self.send_json(200, result)
+
+
+def stitch_serve(path, args):
+    '''
+    Serve stitch commands over HTTP until interrupted
+    '''
+    host = util.pop_option(args, "--host", DEFAULT_HOST)
+    port = util.pop_option(args, "--port", DEFAULT_PORT, int)
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    cache_size = util.pop_option(args, "--cache-size", None, int)
+    max_projects = util.pop_option(args, "--max-projects", MAX_PROJECTS, int)
+    if len(args) != 0:
+        print("Invalid arguments")
+        sys.exit()
+    if cache_size is not None:
+        tilecache.shared.set_max_bytes(cache_size * 1024 * 1024)
+    httpd = StitchServer((host, port), path, jobs, max_projects)
+    print("Serving on http://{}:{}/, press Ctrl+C to stop."
+          .format(*httpd.server_address[:2]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped serving.")
+    finally:
+        httpd.server_close()
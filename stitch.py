@@ -1,11 +1,21 @@
 import os
 import sys
 import json
+import hashlib
 import math
+from concurrent import futures
 import util
+import timing
+import tilecache
+import pngwriter
 from PIL import Image
 
 
+# Version of the json files written by StitchData.export_to_json. Version 1
+# files have no "version" key and no "tiles" index.
+VERSION = 2
+
+
 class StitchData:
     '''
     StitchData contains all of the necessary data to stitch textures together
@@ -14,8 +24,11 @@ class StitchData:
     tex_width  - width of each individual texture
     tex_height - height of each individual texture
     texlist    - list of textures, in order, that make up the final image
+    tile_index - information about each texture, keyed by filename, as
+                 returned by get_tile_info
     output     - filename of output
     path       - path to this stitchdata
+    version    - version of the json file this stitchdata was imported from
 
     All paths are dealt in absolutes
     The exported json file will have relative file names
@@ -24,10 +37,13 @@ class StitchData:
     tex_width = 1
     tex_height = 1
     texlist = None
+    tile_index = None
     path = ""
+    version = VERSION
 
     def __init__(self):
         self.texlist = []
+        self.tile_index = {}
 
     def get_img_width(self):
         return self.width * self.tex_width
@@ -35,57 +51,341 @@ class StitchData:
     def get_img_height(self):
         return self.tex_height * math.ceil(len(self.texlist) / self.width)
 
-    def get_stitched_image(self):
+    def get_tile_pos(self, i):
+        '''
+        Get the position of the top-left corner of the i-th tile in the
+        stitched image
+        '''
+        x = i % self.width
+        y = i // self.width
+        return (x * self.tex_width, y * self.tex_height)
+
+    def load_tile(self, fname, use_cache=True):
+        '''
+        Get a texture as a tile, through tilecache.shared if use_cache is set
+
+        Returns None if the texture can not be read
+        '''
+        try:
+            if use_cache:
+                return tilecache.shared.get_tile(
+                    fname, self.tex_width, self.tex_height)
+            return tilecache.load_tile(fname, self.tex_width, self.tex_height)
+        except IOError:
+            return None
+
+    def iter_tiles(self, indices=None, jobs=1, use_cache=True):
+        '''
+        Load tiles, yielding (i, tile) for each of them. Tiles that can not be
+        read are yielded as None.
+
+        indices   - indices into texlist of tiles to load, all tiles if None
+        jobs      - number of tiles to load at the same time. If more than 1,
+                    tiles are yielded in the order that they finish loading.
+        use_cache - whether to keep tiles in tilecache.shared
+        '''
+        if indices is None:
+            indices = range(len(self.texlist))
+        if jobs <= 1:
+            for i in indices:
+                yield i, self.load_tile(self.texlist[i], use_cache)
+            return
+        # Only keep a few tiles in flight so that memory stays bounded
+        max_pending = jobs * 4
+        with util.make_pool(jobs) as pool:
+            pending = {}
+            for i in indices:
+                future = pool.submit(self.load_tile, self.texlist[i],
+                                     use_cache)
+                pending[future] = i
+                if len(pending) >= max_pending:
+                    done, _ = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            for future in futures.as_completed(pending):
+                yield pending[future], future.result()
+
+    def get_stitched_image(self, jobs=1, progress=None):
+        '''
+        Stitch every texture together into a single image. Decoded tiles are
+        kept in tilecache.shared, so only textures that changed since the
+        last call are read from disk.
+
+        jobs     - number of textures to decode at the same time
+        progress - called with (tiles pasted, total tiles) after each tile
+        '''
         outwidth = self.width * self.tex_width
         outheight = self.tex_height * math.ceil(len(self.texlist) / self.width)
         # Create image
         image = Image.new('RGBA', (outwidth, outheight), (0, 0, 0, 255))
-        x = 0
-        y = 0
-        for fname in self.texlist:
-            try:
-                part = Image.open(fname).convert("RGBA")
-            except IOError:
-                pass
-            part = part.crop((0, 0, self.tex_width, self.tex_height))
-            ox = x * self.tex_width
-            oy = y * self.tex_height
-            image.paste(part, (ox, oy))
-            x += 1
-            if x >= self.width:
-                x = 0
-                y += 1
+        # Tiles never overlap, so the order they are pasted in does not matter
+        for done, (i, part) in enumerate(self.iter_tiles(jobs=jobs)):
+            if part is not None:
+                with timing.phase("paste"):
+                    image.paste(part, self.get_tile_pos(i))
+            if progress is not None:
+                progress(done + 1, len(self.texlist))
         return image
 
-    def unpack_image(self, image):
-        x = 0
-        y = 0
-        # Unpack into multiple textures
+    def iter_stitched_rows(self, jobs=1, use_cache=True):
+        '''
+        Stitch textures together one row of tiles at a time, yielding each
+        row as an image that is as wide as the stitched image and tex_height
+        tall, from top to bottom. Only about one row of tiles is kept in
+        memory at a time.
+
+        jobs      - number of textures to decode at the same time
+        use_cache - whether to keep tiles in tilecache.shared
+        '''
+        outwidth = self.width * self.tex_width
+        # Each value is [row image, number of tiles still to be pasted]
+        rows = {}
+        next_row = 0
+        for i, part in self.iter_tiles(jobs=jobs, use_cache=use_cache):
+            y = i // self.width
+            if y not in rows:
+                count = min(self.width, len(self.texlist) - y*self.width)
+                row = Image.new('RGBA', (outwidth, self.tex_height),
+                                (0, 0, 0, 255))
+                rows[y] = [row, count]
+            if part is not None:
+                x = i % self.width
+                with timing.phase("paste"):
+                    rows[y][0].paste(part, (x * self.tex_width, 0))
+            rows[y][1] -= 1
+            # Rows must be yielded in order
+            while next_row in rows and rows[next_row][1] == 0:
+                yield rows.pop(next_row)[0]
+                next_row += 1
+
+    def save_stitched_png(self, fname, jobs=1):
+        '''
+        Stitch every texture together and write the result to a PNG file as
+        it is stitched, one row of tiles at a time. Unlike
+        get_stitched_image, this never keeps the whole image in memory, and
+        tiles are not kept in tilecache.shared.
+
+        fname - name of PNG file to write
+        jobs  - number of textures to decode at the same time
+        '''
+        with open(fname, 'wb') as fh:
+            writer = pngwriter.PngWriter(
+                fh, self.get_img_width(), self.get_img_height())
+            for row in self.iter_stitched_rows(jobs, use_cache=False):
+                with timing.phase("save"):
+                    writer.write_rows(row)
+            with timing.phase("save"):
+                writer.close()
+
+    def get_current_info(self, fname):
+        '''
+        Get a texture's entry in tile_index if the texture has not changed
+        since, going by its size and modification time
+
+        Returns None if there is no entry or it is out of date
+        '''
+        info = self.tile_index.get(fname)
+        if info is None:
+            return None
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        if stat.st_mtime_ns != info["mtime"] or stat.st_size != info["size"]:
+            return None
+        return info
+
+    def update_index(self):
+        '''
+        Bring tile_index up to date with texlist. Only textures that changed
+        since they were indexed are read. Textures that can not be read are
+        left out of the index.
+        '''
+        index = {}
         for fname in self.texlist:
-            part = Image.open(fname).convert("RGBA")
-            cx = x*self.tex_width
-            cy = y*self.tex_height
-            cw = part.width
-            ch = part.height
-            croparea = (cx, cy, min(cx+cw, image.width),
-                        min(cy+ch, image.height))
-            cropped = image.crop(croparea)
-            part.paste(cropped, (1, 0))
-            part.paste(cropped, (0, 0))
-            part.save(fname)
-            x += 1
-            if x >= self.width:
-                x = 0
-                y += 1
+            if fname in index:
+                continue
+            info = self.get_current_info(fname)
+            if info is None:
+                try:
+                    info = read_tile_info(fname)
+                except IOError:
+                    continue
+            index[fname] = info
+        self.tile_index = index
+
+    def get_tile_area(self, i, size, image):
+        '''
+        Get the box of an image that the i-th texture is unpacked from
+
+        size  - size of the texture
+        image - image being unpacked
+        '''
+        cx, cy = self.get_tile_pos(i)
+        return (cx, cy, min(cx+size[0], image.width),
+                min(cy+size[1], image.height))
+
+    def iter_unpacked_tiles(self, image, indices=None):
+        '''
+        Crop the section of an image belonging to each texture, yielding
+        (texture filename, cropped image, index entry, error). Textures with
+        a current entry in tile_index are not read at all, otherwise only
+        their header is read to find their size. If a texture can not be
+        read, cropped is None and error is set.
+
+        image   - RGBA image to split up
+        indices - indices into texlist of textures to crop, all if None
+        '''
+        if indices is None:
+            indices = range(len(self.texlist))
+        for i in indices:
+            fname = self.texlist[i]
+            info = self.get_current_info(fname)
+            if info is not None:
+                size = (info["width"], info["height"])
+            else:
+                try:
+                    with timing.phase("open"), Image.open(fname) as part:
+                        size = part.size
+                except IOError as e:
+                    yield fname, None, None, e
+                    continue
+            with timing.phase("crop"):
+                cropped = image.crop(self.get_tile_area(i, size, image))
+            yield fname, cropped, info, None
+
+    def unpack_image(self, image, jobs=1, indices=None, progress=None):
+        '''
+        Split an image into the textures in texlist, overwriting them.
+        Textures whose pixels would not change are not written. A texture
+        that fails does not stop the others from being unpacked. tile_index
+        is updated for every texture that is checked.
+
+        image   - RGBA image to split up
+        jobs    - number of textures to encode at the same time, each in its
+                  own process
+        indices  - indices into texlist of textures to unpack, all if None
+        progress - called with (textures checked, total textures) after each
+                   texture
+
+        Returns (number of textures written, list of (filename, error) for
+        every texture that failed)
+        '''
+        written = 0
+        errors = []
+        checked = 0
+        total = len(self.texlist) if indices is None else len(indices)
+
+        def report():
+            nonlocal checked
+            checked += 1
+            if progress is not None:
+                progress(checked, total)
+
+        def finish(fname, result):
+            nonlocal written
+            was_written, info = result
+            if was_written:
+                written += 1
+            if info is not None:
+                self.tile_index[fname] = info
+            report()
+
+        def fail(fname, error):
+            errors.append((fname, error))
+            report()
+
+        tiles = self.iter_unpacked_tiles(image, indices)
+        if jobs <= 1:
+            for fname, cropped, info, error in tiles:
+                if error is None:
+                    try:
+                        finish(fname, unpack_tile(fname, cropped, info))
+                        continue
+                    except (IOError, ValueError) as e:
+                        error = e
+                fail(fname, error)
+            return written, errors
+        # Only keep a few tiles in flight so that memory stays bounded
+        max_pending = jobs * 2
+        with util.make_pool(jobs, processes=True) as pool:
+            pending = {}
+            for fname, cropped, info, error in tiles:
+                if error is not None:
+                    fail(fname, error)
+                    continue
+                future = pool.submit(unpack_tile_data, fname, cropped.size,
+                                     cropped.tobytes(), info)
+                pending[future] = fname
+                if len(pending) >= max_pending:
+                    done, _ = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        fname = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except (IOError, ValueError) as e:
+                            fail(fname, e)
+                        else:
+                            finish(fname, result)
+            for future in futures.as_completed(pending):
+                try:
+                    result = future.result()
+                except (IOError, ValueError) as e:
+                    fail(pending[future], e)
+                else:
+                    finish(pending[future], result)
+        return written, errors
+
+    def verify(self, image=None):
+        '''
+        Find textures that are out of date. Textures with a current entry in
+        tile_index are not read.
+
+        image - if given, find textures that differ from this stitched image,
+                i.e. the textures unpack_image would write. Otherwise find
+                textures that changed since tile_index was last updated.
+                Textures that are not indexed yet are added to tile_index as
+                they are now, so that later changes can be found.
+
+        Returns a list of (filename, reason) for every texture found
+        '''
+        found = []
+        if image is None:
+            for fname in self.texlist:
+                info = self.tile_index.get(fname)
+                if info is None:
+                    try:
+                        self.tile_index[fname] = read_tile_info(fname)
+                    except IOError as e:
+                        found.append((fname, str(e)))
+                elif self.get_current_info(fname) is None:
+                    try:
+                        if read_tile_info(fname)["hash"] != info["hash"]:
+                            found.append((fname, "changed"))
+                    except IOError as e:
+                        found.append((fname, str(e)))
+            return found
+        for fname, cropped, info, error in self.iter_unpacked_tiles(image):
+            if error is not None:
+                found.append((fname, str(error)))
+            elif get_unpacked_tile(fname, cropped, info)[0] is not None:
+                found.append((fname, "differs from image"))
+        return found
 
     def get_dir(self):
         return os.path.dirname(self.path)
 
-    def export_to_json(self, fname=None):
+    def export_to_json(self, fname=None, update_index=True):
         '''
         Export this StitchData to a json file
 
-        fname - name of file to export to
+        fname        - name of file to export to
+        update_index - whether to bring tile_index up to date first, which
+                       reads every texture that is not indexed yet. If
+                       False, textures are indexed the next time they are
+                       unpacked or verified instead.
 
         Returns True if could not save
         '''
@@ -94,11 +394,25 @@ class StitchData:
         if fname == "":
             return True
         path = self.get_dir()
+        if update_index:
+            self.update_index()
+        else:
+            # Only drop textures that are no longer used
+            used = set(self.texlist)
+            self.tile_index = {
+                name: info for name, info in self.tile_index.items()
+                if name in used
+            }
         data = {
+            "version": VERSION,
             "width": self.width,
             "tex_width": self.tex_width,
             "tex_height": self.tex_height,
             "files": [os.path.relpath(name, path) for name in self.texlist],
+            "tiles": {
+                os.path.relpath(name, path): info
+                for name, info in self.tile_index.items()
+            },
         }
         with open(fname, 'w') as fh:
             fh.write(json.dumps(data, indent=4, sort_keys=True))
@@ -122,9 +436,117 @@ class StitchData:
                 os.path.abspath(os.path.join(path, name))
                 for name in jdata["files"]
             ]
+            sdata.version = jdata.get("version", 1)
+            sdata.tile_index = {
+                os.path.abspath(os.path.join(path, name)): info
+                for name, info in jdata.get("tiles", {}).items()
+            }
         return sdata
 
 
+def get_tile_info(image, mode, stat):
+    '''
+    Get the information stored about a texture in a StitchData's tile_index
+
+    image - the texture, converted to RGBA
+    mode  - mode of the texture file, e.g. 'RGB'
+    stat  - result of os.stat on the texture file
+    '''
+    return {
+        "width": image.width,
+        "height": image.height,
+        "mode": mode,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": get_pixel_hash(image),
+    }
+
+
+def get_pixel_hash(image):
+    '''
+    Hash the pixel data of an RGBA image
+    '''
+    with timing.phase("hash"):
+        return hashlib.sha1(image.tobytes()).hexdigest()
+
+
+def read_tile_info(fname):
+    '''
+    Read a texture to get its information for tile_index
+    '''
+    stat = os.stat(fname)
+    with timing.phase("open"):
+        part = Image.open(fname)
+        part.load()
+    with timing.phase("convert"):
+        image = part.convert("RGBA")
+    return get_tile_info(image, part.mode, stat)
+
+
+def get_unpacked_tile(fname, cropped, info=None):
+    '''
+    Paste a section of a stitched image over a texture
+
+    fname   - filename of texture
+    cropped - section of the stitched image belonging to the texture
+    info    - the texture's current tile_index entry, if any. If the section
+              covers the whole texture, the texture does not need to be read.
+
+    Returns (new texture, info). The new texture is None if its pixels are
+    unchanged. info is the texture's tile_index entry if it was read.
+    '''
+    if info is not None and cropped.width + 1 >= info["width"] and\
+            cropped.height >= info["height"]:
+        with timing.phase("paste"):
+            newpart = Image.new("RGBA", (info["width"], info["height"]))
+            newpart.paste(cropped, (1, 0))
+            newpart.paste(cropped, (0, 0))
+        if get_pixel_hash(newpart) == info["hash"]:
+            return None, None
+        return newpart, None
+    stat = os.stat(fname)
+    with timing.phase("open"):
+        part = Image.open(fname)
+        part.load()
+    mode = part.mode
+    with timing.phase("convert"):
+        part = part.convert("RGBA")
+    with timing.phase("paste"):
+        newpart = part.copy()
+        newpart.paste(cropped, (1, 0))
+        newpart.paste(cropped, (0, 0))
+    if newpart.tobytes() == part.tobytes():
+        return None, get_tile_info(part, mode, stat)
+    return newpart, None
+
+
+def unpack_tile(fname, cropped, info=None):
+    '''
+    Paste a section of a stitched image over a texture, and save the texture
+    if any of its pixels changed
+
+    fname   - filename of texture
+    cropped - section of the stitched image belonging to the texture
+    info    - the texture's current tile_index entry, if any
+
+    Returns (True if the texture was written, new tile_index entry or None)
+    '''
+    newpart, info = get_unpacked_tile(fname, cropped, info)
+    if newpart is None:
+        return False, info
+    with timing.phase("save"):
+        newpart.save(fname)
+    return True, get_tile_info(newpart, newpart.mode, os.stat(fname))
+
+
+def unpack_tile_data(fname, size, data, info=None):
+    '''
+    Same as unpack_tile, but takes the section as raw RGBA data so that it can
+    be sent to a worker process
+    '''
+    return unpack_tile(fname, Image.frombytes("RGBA", size, data), info)
+
+
 def pick_files_individual(data, path):
     '''
     Picks files one by one from a given path
@@ -167,7 +589,7 @@ def stitch_new(path, args, pickf=pick_files_individual):
     # Get files
     pickf(data, path)
     # Output
-    data.export_to_json()
+    data.export_to_json(update_index=False)
     print("Created file.")
 
 
@@ -175,18 +597,42 @@ def stitch_pack(path, args):
     '''
     Use a StitchData json file to pack multiple textures into a single image
     '''
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    stream = util.pop_flag(args, "--stream")
+    use_incremental = util.pop_flag(args, "--incremental")
     # Figure out paths
     if len(args) != 2:
         print("Invalid arguments")
         sys.exit()
     datafile = os.path.join(path, args[0])
     path = os.path.dirname(datafile)
+    if stream and use_incremental:
+        print("Only one of --stream and --incremental may be given")
+        sys.exit()
+    if stream and os.path.splitext(args[1])[1].lower() != ".png":
+        print("--stream can only write PNG images")
+        sys.exit()
     # Get data
     data = StitchData.import_from_json(datafile)
-    # Create image
-    image = data.get_stitched_image()
-    # Save image
-    image.save(args[1])
+    if use_incremental:
+        import incremental
+        # Only paste tiles that changed
+        changed, total = incremental.pack_incremental(data, args[1], jobs)
+        print("Finished packing, updated {} of {} tiles."
+              .format(changed, total))
+        return
+    if stream:
+        # Create and save image one row at a time
+        if len(data.texlist) == 0:
+            print("There are no textures to pack")
+            sys.exit()
+        data.save_stitched_png(args[1], jobs)
+    else:
+        # Create image
+        image = data.get_stitched_image(jobs)
+        # Save image
+        with timing.phase("save"):
+            image.save(args[1])
     print("Finished packing.")
 
 
@@ -194,6 +640,7 @@ def stitch_unpack(path, args):
     '''
     Use a StitchData json file to unpack an image into multiple textures
     '''
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
     # Figure out paths
     if len(args) != 2:
         print("Invalid arguments")
@@ -202,5 +649,49 @@ def stitch_unpack(path, args):
     path = os.path.dirname(datafile)
     # Get data
     data = StitchData.import_from_json(datafile)
-    data.unpack_image(Image.open(args[1]).convert("RGBA"))
-    print("Finished unpacking")
+    with timing.phase("open"):
+        image = Image.open(args[1])
+        image.load()
+    with timing.phase("convert"):
+        image = image.convert("RGBA")
+    indexed = dict(data.tile_index)
+    written, errors = data.unpack_image(image, jobs)
+    for fname, error in errors:
+        print("Could not unpack {}: {}".format(fname, error))
+    print("Finished unpacking, wrote {} of {} textures."
+          .format(written, len(data.texlist)))
+    # Keep the project's index up to date for the next run, even if no
+    # textures were written
+    if data.version >= 2 and data.tile_index != indexed:
+        data.export_to_json(update_index=False)
+    if len(errors) > 0:
+        print("{} textures could not be unpacked.".format(len(errors)))
+        sys.exit(1)
+
+
+def stitch_verify(path, args):
+    '''
+    Use a StitchData json file to find textures that are out of date
+    '''
+    # Figure out paths
+    if len(args) != 1 and len(args) != 2:
+        print("Invalid arguments")
+        sys.exit()
+    datafile = os.path.join(path, args[0])
+    # Get data
+    data = StitchData.import_from_json(datafile)
+    image = None
+    if len(args) == 2:
+        image = Image.open(args[1]).convert("RGBA")
+    indexed = len(data.tile_index)
+    found = data.verify(image)
+    # Keep textures that were indexed for the first time
+    if data.version >= 2 and len(data.tile_index) > indexed:
+        data.export_to_json(update_index=False)
+    for fname, reason in found:
+        print("{}: {}".format(fname, reason))
+    if len(found) > 0:
+        print("{} of {} textures are out of date."
+              .format(len(found), len(data.texlist)))
+        sys.exit(1)
+    print("All textures are up to date.")
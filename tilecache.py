@@ -0,0 +1,144 @@
+import os
+import threading
+import collections
+
+from PIL import Image
+import timing
+
+# Default maximum amount of decoded tile data kept in memory, in bytes
+MAX_BYTES = 256 * 1024 * 1024
+
+
+def load_tile(fname, width, height):
+    '''
+    Decode a texture and crop it to the size of a tile
+
+    fname  - filename of texture
+    width  - width of tile
+    height - height of tile
+    '''
+    with timing.phase("open"):
+        part = Image.open(fname)
+        part.load()
+    with timing.phase("convert"):
+        part = part.convert("RGBA")
+    with timing.phase("crop"):
+        return part.crop((0, 0, width, height))
+
+
+class TileCache:
+    '''
+    TileCache keeps recently used tiles decoded in memory, so that stitching
+    the same textures again does not have to read them from disk.
+
+    Tiles are keyed by absolute filename, modification time, file size and
+    tile size, so a texture that changes on disk is decoded again. Once more
+    than max_bytes of tiles are cached, the least recently used tiles are
+    evicted.
+
+    Tiles returned by the cache are shared and must not be modified.
+
+    max_bytes - maximum amount of decoded tile data to keep
+    tiles     - cached tiles, least recently used first
+    '''
+    max_bytes = MAX_BYTES
+    tiles = None
+    keys = None
+    loading = None
+    lock = None
+    nbytes = 0
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.tiles = collections.OrderedDict()
+        self.keys = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get_tile(self, fname, width, height):
+        '''
+        Get a texture decoded, converted to RGBA and cropped to the size of a
+        tile. Raises IOError if the texture can not be read.
+
+        fname  - filename of texture
+        width  - width of tile
+        height - height of tile
+        '''
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        key = (fname, stat.st_mtime_ns, stat.st_size, width, height)
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                return tile
+            # If another thread is already decoding this tile, wait for it
+            # instead of decoding it again
+            event = self.loading.get(key)
+            is_loading = event is None
+            if is_loading:
+                event = threading.Event()
+                self.loading[key] = event
+        if not is_loading:
+            event.wait()
+            with self.lock:
+                tile = self.tiles.get(key)
+            if tile is not None:
+                return tile
+            # The other thread failed, or the tile was already evicted
+            return load_tile(fname, width, height)
+        try:
+            tile = load_tile(fname, width, height)
+            self.add_tile(key, tile)
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+        return tile
+
+    def add_tile(self, key, tile):
+        with self.lock:
+            # Older versions of the same texture will not be used again
+            for old_key in list(self.keys.get(key[0], ())):
+                if old_key[1:3] != key[1:3]:
+                    self.remove_tile(old_key)
+            if key in self.tiles:
+                return
+            self.tiles[key] = tile
+            self.keys.setdefault(key[0], set()).add(key)
+            self.nbytes += get_tile_bytes(tile)
+            self.evict()
+
+    def remove_tile(self, key):
+        tile = self.tiles.pop(key)
+        self.nbytes -= get_tile_bytes(tile)
+        keys = self.keys[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.keys[key[0]]
+
+    def evict(self):
+        '''
+        Evict least recently used tiles until the cache fits in max_bytes
+        '''
+        while self.nbytes > self.max_bytes and len(self.tiles) > 0:
+            self.remove_tile(next(iter(self.tiles)))
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.keys.clear()
+            self.nbytes = 0
+
+
+def get_tile_bytes(tile):
+    return tile.width * tile.height * 4
+
+
+# Cache shared by everything that stitches images
+shared = TileCache()
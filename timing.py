@@ -0,0 +1,151 @@
+import sys
+import json
+import time
+import threading
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Phases are only timed while enabled, otherwise phase() does nothing
+enabled = False
+# Whether to keep every call to write a trace
+tracing = False
+
+# Stats of each phase keyed by name, see Stats
+stats = {}
+# Chrome trace events, if tracing
+events = []
+# Number of phases currently running in any thread
+active = 0
+lock = threading.Lock()
+start_time = 0
+
+NULL_PHASE = contextlib.nullcontext()
+
+
+class Stats:
+    '''
+    Stats collected about a phase
+
+    calls    - number of times the phase ran
+    seconds  - total wall time spent in the phase. Phases running at the same
+               time in several threads each count their own time.
+    py_peak  - largest amount of memory allocated by Python while the phase
+               ran, above what was allocated when it started. Approximate
+               when phases overlap.
+    rss_peak - how much the phase raised the peak memory of the process
+    '''
+    calls = 0
+    seconds = 0.0
+    py_peak = 0
+    rss_peak = 0
+
+
+def get_max_rss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else kilobytes
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+
+def start(trace=False):
+    '''
+    Start timing phases
+
+    trace - whether to keep every call, for write_trace
+    '''
+    global enabled, tracing, start_time
+    stats.clear()
+    del events[:]
+    tracing = trace
+    start_time = time.perf_counter()
+    tracemalloc.start()
+    enabled = True
+
+
+def stop():
+    global enabled
+    enabled = False
+    tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def run_phase(name):
+    global active
+    with lock:
+        if active == 0:
+            tracemalloc.reset_peak()
+        active += 1
+    py_start = tracemalloc.get_traced_memory()[0]
+    rss_start = get_max_rss()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t
+        py_peak = tracemalloc.get_traced_memory()[1] - py_start
+        rss_peak = get_max_rss() - rss_start
+        with lock:
+            active -= 1
+            phase_stats = stats.get(name)
+            if phase_stats is None:
+                phase_stats = stats[name] = Stats()
+            phase_stats.calls += 1
+            phase_stats.seconds += seconds
+            phase_stats.py_peak = max(phase_stats.py_peak, py_peak)
+            phase_stats.rss_peak += rss_peak
+            if tracing:
+                events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (t - start_time) * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": 1,
+                    "tid": threading.get_ident(),
+                })
+
+
+def phase(name):
+    '''
+    Time a phase of work, to be used as 'with timing.phase("open"):'. Only
+    phases in this process are timed, not those run in worker processes.
+    '''
+    if not enabled:
+        return NULL_PHASE
+    return run_phase(name)
+
+
+def print_report(fh=sys.stderr):
+    '''
+    Print the stats of every phase, slowest first
+    '''
+    total = time.perf_counter() - start_time
+    print("{:<14} {:>8} {:>11} {:>10} {:>11} {:>11}".format(
+        "phase", "calls", "total (ms)", "per call", "py peak", "rss peak"),
+        file=fh)
+    for name, s in sorted(stats.items(), key=lambda item: -item[1].seconds):
+        print("{:<14} {:>8} {:>11.1f} {:>8.3f}ms {:>8.1f}MiB {:>8.1f}MiB"
+              .format(name, s.calls, s.seconds * 1000,
+                      s.seconds * 1000 / s.calls, s.py_peak / 2**20,
+                      s.rss_peak / 2**20), file=fh)
+    print("Wall time {:.1f}ms, peak memory {:.1f}MiB".format(
+        total * 1000, get_max_rss() / 2**20), file=fh)
+
+
+def write_trace(fname):
+    '''
+    Write every call of every phase as a Chrome trace, which can be opened
+    with chrome://tracing or Perfetto
+    '''
+    with lock:
+        trace = {"traceEvents": list(events), "displayTimeUnit": "ms"}
+    with open(fname, 'w') as fh:
+        fh.write(json.dumps(trace))
@@ -1,6 +1,6 @@
-from PIL import Image, ImageTk
-from tkinter import filedialog as tk_fd
-import tkinter as tk
+from PIL import Image
+import concurrent.futures
+import sys
 import os
 
 FILES_IMG = (("Image files", ("*.jpg", "*.png")), ("All files", "*.*"))
@@ -8,6 +8,12 @@ FILES_STITCH = (("Json file", ("*.json")), ("All files", "*.*"))
 
 data_path = None
 
+# tkinter is only imported by the functions below that show windows, so that
+# commands which don't show any can run without Tk installed
+
+# Number of jobs used when the user does not choose one, such as in the GUI
+DEFAULT_JOBS = os.cpu_count() or 1
+
 
 def input_int(prompt, imin=None, imax=None):
     '''
@@ -32,6 +38,67 @@ def input_int(prompt, imin=None, imax=None):
             print("Not a valid integer!")
 
 
+def pop_option(args, name, default=None, conv=str):
+    '''
+    Remove an option of the form '{name} {value}' from a list of command line
+    arguments and return its value. Exits if the value is missing or invalid.
+
+    args    - list of command line arguments, modified in place
+    name    - name of option, e.g. '--jobs'
+    default - value returned if the option is not given
+    conv    - function used to convert the value from a string
+    '''
+    if name not in args:
+        return default
+    i = args.index(name)
+    if i + 1 >= len(args):
+        print("Missing value for {}".format(name))
+        sys.exit()
+    value = args[i+1]
+    del args[i:i+2]
+    try:
+        return conv(value)
+    except ValueError:
+        print("Invalid value for {}: {}".format(name, value))
+        sys.exit()
+
+
+def pop_flag(args, name):
+    '''
+    Remove a flag from a list of command line arguments
+
+    Returns True if the flag was given
+    '''
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+def parse_jobs(value):
+    '''
+    Convert a --jobs value to a number of jobs, where 0 means one job per CPU
+    '''
+    jobs = int(value)
+    if jobs < 0:
+        raise ValueError(value)
+    if jobs == 0:
+        return DEFAULT_JOBS
+    return jobs
+
+
+def make_pool(jobs, processes=False):
+    '''
+    Create a pool to run jobs on
+
+    jobs      - maximum number of jobs to run at the same time
+    processes - use worker processes instead of threads
+    '''
+    if processes:
+        return concurrent.futures.ProcessPoolExecutor(jobs)
+    return concurrent.futures.ThreadPoolExecutor(jobs)
+
+
 _icon_cache = {}
 
 
@@ -40,6 +107,7 @@ def load_icon(name):
         name = os.path.join(data_path, name)
     if name in _icon_cache:
         return _icon_cache[name]
+    from PIL import ImageTk
     img = Image.open(name)
     imgtk = ImageTk.PhotoImage(img)
     _icon_cache[name] = imgtk
@@ -47,6 +115,8 @@ def load_icon(name):
 
 
 def get_in_filename(initialdir, title, filetypes):
+    import tkinter as tk
+    from tkinter import filedialog as tk_fd
     root = tk.Tk()
     root.withdraw()
     value = None
@@ -60,6 +130,8 @@ def get_in_filename(initialdir, title, filetypes):
 
 
 def get_out_filename(initialdir, title, filetypes):
+    import tkinter as tk
+    from tkinter import filedialog as tk_fd
     root = tk.Tk()
     root.withdraw()
     value = None
@@ -73,6 +145,8 @@ def get_out_filename(initialdir, title, filetypes):
 
 
 def get_directory(initialdir, title):
+    import tkinter as tk
+    from tkinter import filedialog as tk_fd
     root = tk.Tk()
     root.withdraw()
     value = None
@@ -85,6 +159,8 @@ def get_directory(initialdir, title):
 
 
 def get_many_files(initialdir, title, filetypes):
+    import tkinter as tk
+    from tkinter import filedialog as tk_fd
     root = tk.Tk()
     root.withdraw()
     value = None
@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+
+from PIL import Image
+import util
+import stitch
+import tilecache
+
+# Seconds between checking files for changes
+POLL_INTERVAL = 0.5
+# Seconds that files must stay unchanged before they are synced, so that an
+# editor saving a file several times in a row only causes one update
+DEBOUNCE = 1.0
+
+
+def get_stat(fname):
+    '''
+    Get what is compared to find out if a file changed, or None if the file
+    does not exist
+    '''
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_image(fname):
+    image = Image.open(fname)
+    image.load()
+    return image.convert("RGBA")
+
+
+class Watcher:
+    '''
+    Watcher keeps a stitch project's textures and its packed image in sync.
+    When the image changes, the textures whose cells changed are unpacked.
+    When textures change, only their cells are pasted into the image.
+
+    Changes are only synced once files stop changing for debounce seconds.
+    Files written by the watcher itself are not treated as changes.
+
+    data       - StitchData being watched
+    imagename  - filename of packed image
+    jobs       - number of textures to encode at the same time
+    debounce   - seconds files must stay unchanged before syncing
+    image      - the packed image as it was last synced
+    stats      - get_stat of every file as it was last seen
+    pending    - files that changed and have not been synced yet
+    changed_at - time.monotonic() when a change was last seen
+    '''
+    data = None
+    datafile = ""
+    imagename = ""
+    jobs = 1
+    debounce = DEBOUNCE
+    image = None
+    stats = None
+    pending = None
+    changed_at = 0
+
+    def __init__(self, datafile, imagename, jobs=1, debounce=DEBOUNCE):
+        self.datafile = datafile
+        self.imagename = imagename
+        self.jobs = jobs
+        self.debounce = debounce
+        self.pending = set()
+        self.load_project()
+
+    def get_watched_files(self):
+        return [self.datafile, self.imagename] + self.data.texlist
+
+    def load_project(self):
+        '''
+        Load the project and the packed image, packing the image if it does
+        not exist yet
+        '''
+        self.data = stitch.StitchData.import_from_json(self.datafile)
+        self.image = None
+        if os.path.exists(self.imagename):
+            try:
+                self.image = load_image(self.imagename)
+            except IOError as e:
+                print("Could not read {}: {}".format(self.imagename, e))
+        if self.image is None:
+            self.image = self.data.get_stitched_image(self.jobs)
+            self.image.save(self.imagename)
+            print("Packed {}.".format(self.imagename))
+        self.stats = {}
+        for fname in self.get_watched_files():
+            self.stats[fname] = get_stat(fname)
+        self.pending.clear()
+
+    def poll(self):
+        '''
+        Check every file for changes, syncing them once they settle
+        '''
+        now = time.monotonic()
+        for fname in self.get_watched_files():
+            stat = get_stat(fname)
+            if stat != self.stats.get(fname):
+                self.stats[fname] = stat
+                self.pending.add(fname)
+                self.changed_at = now
+        if len(self.pending) > 0 and now - self.changed_at >= self.debounce:
+            self.sync()
+
+    def sync(self):
+        pending = self.pending
+        self.pending = set()
+        if self.datafile in pending:
+            print("{} changed, reloading.".format(self.datafile))
+            self.load_project()
+            return
+        image = None
+        touched = set()
+        if self.imagename in pending:
+            try:
+                image = load_image(self.imagename)
+            except IOError as e:
+                # The image may still be being written, so try again later
+                print("Could not read {}: {}".format(self.imagename, e))
+                self.pending = pending
+                self.changed_at = time.monotonic()
+                return
+            if image.size != self.image.size:
+                print("{} is {}x{}, expected {}x{}, ignoring it.".format(
+                    self.imagename, image.width, image.height,
+                    self.image.width, self.image.height))
+                image = None
+            else:
+                touched = set(self.get_touched_cells(image))
+        # A texture and its cell may have both changed, in which case it is
+        # not clear which should win
+        changed = set()
+        for i, fname in enumerate(self.data.texlist):
+            if fname in pending:
+                if i in touched:
+                    print("Both {} and its cell in {} changed, leaving both "
+                          "as they are.".format(fname, self.imagename))
+                    touched.discard(i)
+                else:
+                    changed.add(i)
+        if image is not None:
+            self.image = image
+            self.unpack_cells(sorted(touched))
+        self.pack_cells(sorted(changed))
+
+    def get_texture_size(self, fname):
+        info = self.data.tile_index.get(fname)
+        if info is not None:
+            return (info["width"], info["height"])
+        # Textures found by auto stitching overlap their neighbours by 1px
+        return (self.data.tex_width + 1, self.data.tex_height + 1)
+
+    def get_touched_cells(self, image):
+        '''
+        Find the textures whose section of an image differs from the image
+        as it was last synced
+
+        Returns indices into texlist
+        '''
+        for i, fname in enumerate(self.data.texlist):
+            area = self.data.get_tile_area(
+                i, self.get_texture_size(fname), image)
+            if image.crop(area).tobytes() != self.image.crop(area).tobytes():
+                yield i
+
+    def unpack_cells(self, indices):
+        if len(indices) == 0:
+            return
+        indexed = dict(self.data.tile_index)
+        written, errors = self.data.unpack_image(
+            self.image, self.jobs, indices)
+        for fname, error in errors:
+            print("Could not unpack {}: {}".format(fname, error))
+        # Don't treat the textures that were just written as changes
+        for i in indices:
+            fname = self.data.texlist[i]
+            self.stats[fname] = get_stat(fname)
+        if self.data.version >= 2 and self.data.tile_index != indexed:
+            self.data.export_to_json(update_index=False)
+            self.stats[self.datafile] = get_stat(self.datafile)
+        print("Unpacked {} changed cells, wrote {} textures."
+              .format(len(indices), written))
+
+    def pack_cells(self, indices):
+        if len(indices) == 0:
+            return
+        black = Image.new('RGBA', (self.data.tex_width, self.data.tex_height),
+                          (0, 0, 0, 255))
+        for i in indices:
+            try:
+                tile = tilecache.load_tile(self.data.texlist[i],
+                                           self.data.tex_width,
+                                           self.data.tex_height)
+            except IOError as e:
+                print("Could not read {}: {}".format(self.data.texlist[i], e))
+                tile = black
+            self.image.paste(tile, self.data.get_tile_pos(i))
+        self.image.save(self.imagename)
+        # Don't treat the image that was just written as a change
+        self.stats[self.imagename] = get_stat(self.imagename)
+        print("Packed {} changed textures.".format(len(indices)))
+
+    def run(self, interval=POLL_INTERVAL):
+        '''
+        Keep polling for changes until interrupted
+        '''
+        print("Watching {} and {}, press Ctrl+C to stop."
+              .format(self.datafile, self.imagename))
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+
+
+def stitch_watch(path, args):
+    '''
+    Keep a StitchData's textures and packed image in sync as either changes
+    '''
+    jobs = util.pop_option(args, "--jobs", 1, util.parse_jobs)
+    interval = util.pop_option(args, "--interval", POLL_INTERVAL, float)
+    debounce = util.pop_option(args, "--debounce", DEBOUNCE, float)
+    if len(args) != 2:
+        print("Invalid arguments")
+        sys.exit()
+    datafile = os.path.join(path, args[0])
+    imagename = os.path.join(path, args[1])
+    watcher = Watcher(datafile, imagename, jobs, debounce)
+    watcher.run(interval)